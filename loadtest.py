@@ -0,0 +1,608 @@
+"""Нагрузочный тест бота без внешних сервисов.
+
+Поднимает локальные заглушки Telegram Bot API, Gemini, Google Custom Search и хостинга
+изображений, затем прогоняет N пользователей через весь сценарий:
+/start -> GPA -> страна -> SAT -> IELTS -> доп. информация -> кнопки карточек -> вопрос.
+
+    python loadtest.py --users 200 --concurrency 50 --gemini-latency 3:0.4
+"""
+import os
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import shutil
+import socket
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timezone
+from io import BytesIO
+
+import aiohttp
+from aiohttp import web
+from google.api_core import exceptions as google_exceptions
+from PIL import Image
+
+UNIVERSITY_POOL = [
+    ("Massachusetts Institute of Technology", "3.9", "1500", "7.0", "57000"),
+    ("Stanford University", "3.9", "1480", "7.0", "58000"),
+    ("Boston University", "3.6", "1350", "6.5", "60000"),
+    ("Northeastern University", "3.5", "1300", "6.5", "59000"),
+    ("University of Toronto", "3.5", "1300", "6.5", "45000"),
+    ("McGill University", "3.4", "1280", "6.5", "30000"),
+    ("Technical University of Munich", "3.3", "", "6.5", "0"),
+    ("Nazarbayev University", "3.0", "1200", "6.0", "0"),
+    ("KIMEP University", "2.8", "", "5.5", "9000"),
+    ("University of Amsterdam", "3.2", "", "6.5", "15000"),
+    ("Seoul National University", "3.6", "1350", "6.5", "8000"),
+    ("National University of Singapore", "3.8", "1450", "7.0", "30000"),
+]
+
+COUNTRIES = ["США", "Канада", "Германия", "Казахстан", "Нидерланды", "Корея", "Сингапур"]
+QUESTIONS = ["Какая стоимость обучения?", "Нужен ли SAT?", "Есть ли общежитие?", "Какие дедлайны?"]
+
+
+class Latency:
+    """Логнормальная задержка, задается как MEDIAN[:SIGMA] в секундах"""
+
+    def __init__(self, spec: str):
+        median, _, sigma = spec.partition(':')
+        self.median = float(median)
+        self.sigma = float(sigma or 0.3)
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    async def wait(self) -> None:
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class FakeService(ABC):
+    """Базовая заглушка: задержка и доля ошибок на каждый запрос"""
+
+    def __init__(self, latency: Latency, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.runner = None
+        self.url = None
+
+    def should_fail(self) -> bool:
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    @abstractmethod
+    def routes(self, app: web.Application) -> None:
+        """Регистрирует обработчики запросов заглушки"""
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        # Свободный порт выбирает система, а сервер слушает уже привязанный сокет
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        host, port = sock.getsockname()
+        await web.SockSite(self.runner, sock).start()
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class FakeTelegram(FakeService):
+    """Заглушка Bot API: запоминает отправленные сообщения по чатам"""
+
+    def __init__(self, latency: Latency, error_rate: float):
+        super().__init__(latency, error_rate)
+        self.messages = defaultdict(dict)
+        self.calls = defaultdict(int)
+        self.error_replies = 0
+        self._message_ids = defaultdict(int)
+        self._file_ids = 0
+        self.first_photo_at = {}
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_post('/bot{token}/{method}', self.handle)
+
+    @staticmethod
+    def _json_field(value):
+        if isinstance(value, str) and value[:1] in '{[':
+            return json.loads(value)
+        return value
+
+    def _message(self, chat_id: int, message_id: int = None, **fields) -> dict:
+        if message_id is None:
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+        message = self.messages[chat_id].get(message_id, {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'UNIVI'}
+        })
+        message.update({key: value for key, value in fields.items() if value is not None})
+        self.messages[chat_id][message_id] = message
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.requests += 1
+        self.calls[method] += 1
+        await self.latency.wait()
+        if self.should_fail():
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}, status=500)
+
+        params = {key: value for key, value in (await request.post()).items()}
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        markup = self._json_field(params.get('reply_markup'))
+        text = params.get('text') or params.get('caption') or ''
+        if '❌' in text:
+            self.error_replies += 1
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'UNIVI', 'username': 'univi_loadtest_bot'}
+        elif method == 'sendMessage':
+            result = self._message(chat_id, text=params['text'], reply_markup=markup)
+        elif method == 'sendPhoto':
+            self.first_photo_at.setdefault(chat_id, time.perf_counter())
+            photo = params.get('photo')
+            if isinstance(photo, str) and not photo.startswith('attach://'):
+                file_id = photo
+            else:
+                self._file_ids += 1
+                file_id = f"photo-{self._file_ids}"
+            result = self._message(
+                chat_id,
+                caption=params.get('caption'),
+                reply_markup=markup,
+                photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]
+            )
+        elif method in ('editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'editMessageMedia'):
+            message_id = int(params['message_id'])
+            fields = {'reply_markup': markup}
+            if method == 'editMessageText':
+                fields['text'] = params['text']
+            elif method == 'editMessageCaption':
+                fields['caption'] = params.get('caption')
+            result = self._message(chat_id, message_id, **fields)
+        elif method == 'deleteMessage':
+            self.messages[chat_id].pop(int(params['message_id']), None)
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+class FakeGemini(FakeService):
+    """Заглушка generate_content: отдает рекомендации, порядок кандидатов или ответ на вопрос"""
+
+    def __init__(self, latency: Latency, error_rate: float, chunks: int):
+        super().__init__(latency, error_rate)
+        self.chunks = chunks
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_post('/generate', self.handle)
+
+    @staticmethod
+    def _university(name, gpa, sat, ielts, tuition) -> dict:
+        return {
+            'name': name,
+            'description': f"{name} - один из ведущих университетов с сильными программами.",
+            'requirements': {
+                'gpa': gpa, 'sat': sat or 'Не требуется', 'ielts': ielts,
+                'documents': 'Транскрипт, эссе, рекомендации', 'additional': 'Собеседование'
+            },
+            'deadlines': {'early': '1 ноября', 'regular': '1 января', 'rolling': 'Нет'},
+            'tuition': {'amount': tuition, 'currency': 'USD'},
+            'programs': ['Computer Science', 'Economics', 'Engineering'],
+            'scholarships': {
+                'types': ['Merit-based', 'Need-based'],
+                'amounts': ['до 50%', 'до 100%'],
+                'requirements': 'Высокий GPA и эссе'
+            }
+        }
+
+    def respond(self, prompt: str) -> str:
+        rng = random.Random(prompt)
+        if '"universities"' in prompt:
+            picked = rng.sample(UNIVERSITY_POOL, 3)
+            return json.dumps({'universities': [self._university(*uni) for uni in picked]}, ensure_ascii=False)
+        if '"order"' in prompt:
+            count = len(re.findall(r'^\s*\d+\. ', prompt, re.MULTILINE))
+            order = list(range(count))
+            rng.shuffle(order)
+            return json.dumps({'order': order})
+        return ("*Коротко:* да. " + "Подробный ответ о поступлении, стоимости и требованиях. " * 12).strip()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        text = self.respond(body['prompt'])
+        usage = {'prompt_token_count': len(body['prompt']) // 4, 'candidates_token_count': len(text) // 4}
+
+        if not body.get('stream'):
+            await self.latency.wait()
+            if self.should_fail():
+                return web.json_response({'error': 'unavailable'}, status=503)
+            return web.json_response({'text': text, 'usage': usage})
+
+        # Первый кусок приходит примерно через пятую часть полной задержки
+        total = self.latency.sample()
+        await asyncio.sleep(total / 5)
+        if self.should_fail():
+            return web.json_response({'error': 'unavailable'}, status=503)
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        step = max(len(text) // self.chunks, 1)
+        for start in range(0, len(text), step):
+            await response.write(json.dumps({'text': text[start:start + step], 'usage': usage}).encode() + b'\n')
+            await asyncio.sleep(total * 4 / 5 / self.chunks)
+        await response.write_eof()
+        return response
+
+
+class FakeGoogle(FakeService):
+    """Заглушка Custom Search и хостинга изображений"""
+
+    def __init__(self, latency: Latency, image_latency: Latency, error_rate: float):
+        super().__init__(latency, error_rate)
+        self.image_latency = image_latency
+        self.image_requests = 0
+        image = Image.new('RGB', (2400, 1600), (40, 90, 160))
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=95)
+        self.image = buffer.getvalue()
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_get('/customsearch/v1', self.handle_search)
+        app.router.add_get('/images/{name}', self.handle_image)
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await self.latency.wait()
+        if self.should_fail():
+            return web.json_response({'error': {'code': 500}}, status=500)
+        slug = re.sub(r'\W+', '-', request.query.get('q', 'campus')).strip('-')
+        return web.json_response({'items': [{'link': f"{self.url}/images/{slug}.jpg"}]})
+
+    async def handle_image(self, request: web.Request) -> web.Response:
+        self.image_requests += 1
+        await self.image_latency.wait()
+        if self.should_fail():
+            return web.Response(status=502)
+        return web.Response(body=self.image, content_type='image/jpeg')
+
+
+class FakeGeminiModel:
+    """Клиент к заглушке Gemini с интерфейсом GenerativeModel.
+
+    Асинхронные вызовы google-generativeai работают только через gRPC, поэтому вместо
+    настоящего SDK бот получает этот тонкий HTTP-клиент к FakeGemini.
+    """
+
+    class Response:
+        def __init__(self, text: str, usage: dict):
+            self.text = text
+            self.parts = [text] if text else []
+            self.usage_metadata = type('UsageMetadata', (), usage)()
+
+    def __init__(self, url: str):
+        self.url = url
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    async def _stream(self, response: aiohttp.ClientResponse):
+        try:
+            async for line in response.content:
+                if line.strip():
+                    data = json.loads(line)
+                    yield self.Response(data['text'], data['usage'])
+        finally:
+            response.release()
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        response = await self._get_session().post(
+            f"{self.url}/generate", json={'prompt': prompt, 'stream': stream}
+        )
+        if response.status != 200:
+            response.release()
+            # Те же исключения, что бросает настоящий SDK, чтобы бот их повторял
+            raise google_exceptions.from_http_status(response.status, f"Gemini returned {response.status}")
+        if stream:
+            return self._stream(response)
+        async with response:
+            data = await response.json()
+        return self.Response(data['text'], data['usage'])
+
+
+class SimulatedUser:
+    """Один пользователь, проходящий весь сценарий"""
+
+    def __init__(self, harness, user_id: int, rng: random.Random):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = rng
+        self.update_id = user_id * 1000
+
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f"user{self.user_id}"}
+
+    def message(self, text: str) -> dict:
+        message = {
+            'message_id': self._next_update_id(),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': self._user(),
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self._next_update_id(), 'message': message}
+
+    def callback(self, data: str, message: dict) -> dict:
+        return {
+            'update_id': self._next_update_id(),
+            'callback_query': {
+                'id': str(self._next_update_id()),
+                'from': self._user(),
+                'chat_instance': str(self.user_id),
+                'data': data,
+                'message': message
+            }
+        }
+
+    def find_button(self, prefix: str):
+        """Ищет последнее сообщение бота с кнопкой, чей callback_data начинается с prefix"""
+        messages = self.harness.telegram.messages[self.user_id]
+        for message_id in sorted(messages, reverse=True):
+            message = messages[message_id]
+            for row in (message.get('reply_markup') or {}).get('inline_keyboard', []):
+                for button in row:
+                    if button.get('callback_data', '').startswith(prefix):
+                        return button['callback_data'], message
+        return None, None
+
+    async def run(self) -> None:
+        started = time.perf_counter()
+        steps = [
+            ('start', self.message('/start')),
+            ('gpa', self.message(self.rng.choice(['3.2', '3.5', '3.8', '/skip']))),
+            ('country', self.message(self.rng.choice(COUNTRIES))),
+            ('sat', self.message(self.rng.choice(['1250', '1400', '/skip']))),
+            ('ielts', self.message(self.rng.choice(['6.0', '6.5', '7.0', '/skip']))),
+            ('additional_info', self.message(self.rng.choice(['/skip', 'Хочу изучать Computer Science']))),
+        ]
+        for name, update in steps:
+            if name == 'additional_info':
+                profile_sent = time.perf_counter()
+            await self.harness.send(name, update)
+
+        # Время от отправки профиля до появления первой карточки университета
+        first_photo_at = self.harness.telegram.first_photo_at.get(self.user_id)
+        if first_photo_at is not None:
+            self.harness.latencies['first_card'].append(first_photo_at - profile_sent)
+
+        for prefix, name in (('r_', 'requirements'), ('s_', 'scholarships'), ('u_', 'details')):
+            data, message = self.find_button(prefix)
+            if data is None:
+                self.harness.failed_steps[name] += 1
+                continue
+            await self.harness.send(name, self.callback(data, message))
+            data, message = self.find_button('back')
+            if data is not None:
+                await self.harness.send('back', self.callback(data, message))
+
+        data, message = self.find_button('q_')
+        if data is not None:
+            await self.harness.send('ask_question', self.callback(data, message))
+            await self.harness.send('question', self.message(self.rng.choice(QUESTIONS)))
+        else:
+            self.harness.failed_steps['ask_question'] += 1
+
+        self.harness.latencies['end_to_end'].append(time.perf_counter() - started)
+
+
+class LoadTest:
+    """Собирает заглушки, приложение бота и генератор нагрузки"""
+
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram(Latency(args.telegram_latency), args.telegram_error_rate)
+        self.gemini = FakeGemini(Latency(args.gemini_latency), args.gemini_error_rate, args.stream_chunks)
+        self.google = FakeGoogle(Latency(args.search_latency), Latency(args.image_latency), args.search_error_rate)
+        self.think_time = Latency(args.think_time)
+        self.latencies = defaultdict(list)
+        self.failed_steps = defaultdict(int)
+        self.updates = 0
+        self.bot = None
+        self.application = None
+        self.workdir = None
+        self._processed = {}
+
+    def on_processed(self, update) -> None:
+        future = self._processed.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def send(self, name: str, data: dict) -> None:
+        from telegram import Update
+
+        # Пауза, пока пользователь читает ответ и набирает следующий
+        await self.think_time.wait()
+        update = Update.de_json(data, self.application.bot)
+        # Апдейт идет тем же путем, что и от Telegram: через очередь запущенного приложения
+        processed = self._processed[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.application.update_queue.put(update)
+        await processed
+        self.latencies[name].append(time.perf_counter() - started)
+        self.updates += 1
+
+    def configure_environment(self) -> None:
+        self.workdir = tempfile.mkdtemp(prefix='univi-loadtest-')
+        os.environ.update({
+            'TELEGRAM_TOKEN': '123456:LOADTEST',
+            'TELEGRAM_API_URL': self.telegram.url,
+            'GEMINI_API_KEY': 'loadtest',
+            'GOOGLE_API_KEY': 'loadtest',
+            'CUSTOM_SEARCH_ENGINE_ID': 'loadtest',
+            'CUSTOM_SEARCH_URL': f"{self.google.url}/customsearch/v1",
+            'IMAGE_CACHE_DIR': os.path.join(self.workdir, 'images'),
+            'FILE_ID_STORE_PATH': os.path.join(self.workdir, 'file_ids.json'),
+            'SHARED_STORE_PATH': os.path.join(self.workdir, 'shared.sqlite3'),
+            'PERSISTENCE_PATH': os.path.join(self.workdir, 'sessions.sqlite3'),
+            'CATALOG_PATH': os.path.join(self.workdir, 'catalog.sqlite3'),
+            'METRICS_PORT': '0',
+        })
+        if not self.args.caches:
+            os.environ.update({
+                'RECOMMENDATION_CACHE_ENABLED': '0',
+                'ANSWER_CACHE_SIZE': '0',
+                'IMAGE_CACHE_MEMORY_MB': '0',
+                'IMAGE_CACHE_DISK_MB': '0',
+            })
+
+    async def run(self) -> dict:
+        for service in (self.telegram, self.gemini, self.google):
+            await service.start()
+        self.configure_environment()
+
+        import main
+
+        model = FakeGeminiModel(self.gemini.url)
+        main.llm.model = model
+        self.application = main.build_application()
+        self.application.update_processor.on_processed = self.on_processed
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        rng = random.Random(self.args.seed)
+
+        async def run_user(user_id):
+            async with semaphore:
+                await SimulatedUser(self, user_id, random.Random(rng.random())).run()
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(run_user(100000 + i) for i in range(self.args.users)))
+            elapsed = time.perf_counter() - started
+        finally:
+            await self.application.stop()
+            await self.application.shutdown()
+            if self.application.post_shutdown:
+                await self.application.post_shutdown(self.application)
+            await model.close()
+            for service in (self.telegram, self.gemini, self.google):
+                await service.stop()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        def percentile(values, q):
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+        steps = {}
+        for name, values in sorted(self.latencies.items(), key=lambda item: item[0] == 'end_to_end'):
+            steps[name] = {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': max(values)
+            }
+        return {
+            'users': self.args.users,
+            'concurrency': self.args.concurrency,
+            'elapsed': elapsed,
+            'users_per_second': self.args.users / elapsed,
+            'updates_per_second': self.updates / elapsed,
+            'steps': steps,
+            'failed_steps': dict(self.failed_steps),
+            'error_replies': self.telegram.error_replies,
+            'telegram_calls': dict(self.telegram.calls),
+            'gemini_requests': self.gemini.requests,
+            'search_requests': self.google.requests,
+            'image_requests': self.google.image_requests,
+            'injected_errors': {
+                'telegram': self.telegram.errors,
+                'gemini': self.gemini.errors,
+                'google': self.google.errors
+            }
+        }
+
+
+def print_report(report: dict) -> None:
+    print(f"\nПользователей: {report['users']} (одновременно {report['concurrency']}), "
+          f"время: {report['elapsed']:.1f} c")
+    print(f"Пропускная способность: {report['users_per_second']:.2f} польз./c, "
+          f"{report['updates_per_second']:.1f} апдейтов/c\n")
+    print(f"{'шаг':<18}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in report['steps'].items():
+        print(f"{name:<18}{stats['count']:>8}" + ''.join(
+            f"{stats[key] * 1000:>10.0f}" for key in ('p50', 'p95', 'p99', 'max')
+        ))
+    print(f"\nЗапросов: Gemini {report['gemini_requests']}, поиск {report['search_requests']}, "
+          f"изображения {report['image_requests']}")
+    print(f"Вызовы Telegram: {report['telegram_calls']}")
+    print(f"Сообщений об ошибке пользователю: {report['error_replies']}, "
+          f"не найдено кнопок: {report['failed_steps']}, внесено ошибок: {report['injected_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест UNIVI на локальных заглушках')
+    parser.add_argument('--users', type=int, default=50, help='сколько пользователей прогнать')
+    parser.add_argument('--concurrency', type=int, default=20, help='сколько пользователей активны одновременно')
+    parser.add_argument('--telegram-latency', default='0.03:0.3', help='задержка Bot API, MEDIAN[:SIGMA] секунд')
+    parser.add_argument('--gemini-latency', default='2:0.4', help='задержка Gemini, MEDIAN[:SIGMA] секунд')
+    parser.add_argument('--search-latency', default='0.3:0.4', help='задержка Custom Search, MEDIAN[:SIGMA] секунд')
+    parser.add_argument('--image-latency', default='0.2:0.5', help='задержка хостинга изображений, MEDIAN[:SIGMA] секунд')
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--search-error-rate', type=float, default=0.0)
+    parser.add_argument('--think-time', default='0', help='пауза пользователя перед каждым шагом, MEDIAN[:SIGMA] секунд')
+    parser.add_argument('--stream-chunks', type=int, default=8, help='на сколько частей делить потоковый ответ')
+    parser.add_argument('--caches', action='store_true', help='не отключать кэши бота')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE', help='сохранить отчет в JSON')
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,40 @@
 import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, filters
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, ExtBot, Updater, BasePersistence, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, PersistenceInput, MessageHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, filters
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
+import functools
 import hashlib
 import json
 import asyncio
+import argparse
+import bisect
+import contextlib
+import contextvars
+import datetime
+import heapq
+import hmac
+import itertools
+import signal
 from io import BytesIO
 import base64
-from PIL import Image
+import csv
+from PIL import Image, ImageOps
 import re
 import aiohttp
+from aiohttp import web
+import math
+import multiprocessing
+import pickle
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -20,53 +44,1321 @@ model = genai.GenerativeModel('gemini-1.5-flash')
 vision_model = genai.GenerativeModel('gemini-pro-vision')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 CUSTOM_SEARCH_ENGINE_ID = os.getenv('CUSTOM_SEARCH_ENGINE_ID')
+CUSTOM_SEARCH_URL = os.getenv('CUSTOM_SEARCH_URL', 'https://www.googleapis.com/customsearch/v1')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '1024'))
+GEMINI_MAX_IN_FLIGHT = int(os.getenv('GEMINI_MAX_IN_FLIGHT', '8'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '60'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv('HTTP_POOL_SIZE_PER_HOST', '10'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_TOTAL_TIMEOUT = float(os.getenv('HTTP_TOTAL_TIMEOUT', '15'))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join('.cache', 'images'))
+IMAGE_CACHE_MEMORY_MB = float(os.getenv('IMAGE_CACHE_MEMORY_MB', '64'))
+IMAGE_CACHE_DISK_MB = float(os.getenv('IMAGE_CACHE_DISK_MB', '1024'))
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', str(7 * 24 * 3600)))
+IMAGE_MISS_TTL = float(os.getenv('IMAGE_MISS_TTL', '900'))
+QA_STREAMING_ENABLED = os.getenv('QA_STREAMING_ENABLED', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_CAPTION_LIMIT = 1024
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '5000'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', str(7 * 24 * 3600)))
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.8'))
+QA_SESSIONS_ENABLED = os.getenv('QA_SESSIONS_ENABLED', '1') == '1'
+QA_SESSION_MAX = int(os.getenv('QA_SESSION_MAX', '10000'))
+QA_SESSION_IDLE_TTL = float(os.getenv('QA_SESSION_IDLE_TTL', '1800'))
+QA_SESSION_MAX_TURNS = int(os.getenv('QA_SESSION_MAX_TURNS', '8'))
+QA_SESSION_TOKEN_BUDGET = int(os.getenv('QA_SESSION_TOKEN_BUDGET', '1500'))
+QA_SESSION_SUMMARIZE = os.getenv('QA_SESSION_SUMMARIZE', '1') == '1'
+QA_HISTORY_LIMIT = 20
+QA_HISTORY_UNIVERSITIES = 10
+QA_HISTORY_QUESTION_CHARS = 500
+UNIVERSITY_STORE_SIZE = int(os.getenv('UNIVERSITY_STORE_SIZE', '5000'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', str(6 * 3600)))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '5'))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', str(20 / 60)))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+RECOMMENDATION_CACHE_ENABLED = os.getenv('RECOMMENDATION_CACHE_ENABLED', '1') == '1'
+RECOMMENDATION_CACHE_SIZE = int(os.getenv('RECOMMENDATION_CACHE_SIZE', '1000'))
+RECOMMENDATION_CACHE_TTL = float(os.getenv('RECOMMENDATION_CACHE_TTL', str(24 * 3600)))
+RECOMMENDATION_GPA_STEP = float(os.getenv('RECOMMENDATION_GPA_STEP', '0.25'))
+RECOMMENDATION_SAT_STEP = float(os.getenv('RECOMMENDATION_SAT_STEP', '50'))
+RECOMMENDATION_IELTS_STEP = float(os.getenv('RECOMMENDATION_IELTS_STEP', '0.5'))
+RECOMMENDATION_STREAMING_ENABLED = os.getenv('RECOMMENDATION_STREAMING_ENABLED', '1') == '1'
+SPECULATION_ENABLED = os.getenv('SPECULATION_ENABLED', '1') == '1'
+SPECULATION_MAX_JOBS = int(os.getenv('SPECULATION_MAX_JOBS', str(max(GEMINI_MAX_IN_FLIGHT // 2, 1))))
+SPECULATION_TTL = float(os.getenv('SPECULATION_TTL', '900'))
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', '1000'))
+PERSISTENCE_ENABLED = os.getenv('PERSISTENCE_ENABLED', '1') == '1'
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'univi.sqlite3')
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '10'))
+IMAGE_MAX_DOWNLOAD_MB = float(os.getenv('IMAGE_MAX_DOWNLOAD_MB', '8'))
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1280'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+CATALOG_ENABLED = os.getenv('CATALOG_ENABLED', '1') == '1'
+CATALOG_PATH = os.getenv('CATALOG_PATH', 'catalog.sqlite3')
+RECOMMENDATION_SOURCE = os.getenv('RECOMMENDATION_SOURCE', 'llm')
+CATALOG_CANDIDATES = int(os.getenv('CATALOG_CANDIDATES', '10'))
+CATALOG_RERANK = os.getenv('CATALOG_RERANK', '1') == '1'
+RECOMMENDATIONS_COUNT = 3
+FILE_ID_STORE_PATH = os.getenv('FILE_ID_STORE_PATH', os.path.join('.cache', 'file_ids.json'))
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+HANDLER_DEADLINE = float(os.getenv('HANDLER_DEADLINE', '90'))
+IMAGE_WAIT_TIMEOUT = float(os.getenv('IMAGE_WAIT_TIMEOUT', '4'))
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.2'))
+RETRY_MAX_DELAY = 2
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+IMAGE_HEDGE_PERCENTILE = float(os.getenv('IMAGE_HEDGE_PERCENTILE', '90'))
+IMAGE_HEDGE_MIN_DELAY = 0.25
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Одному процессу общее хранилище ничего не дает, а каждый промах кэша обходится запросом к SQLite
+SHARED_STORE_ENABLED = os.getenv('SHARED_STORE_ENABLED', '1' if WORKERS > 1 else '0') == '1'
+SHARED_STORE_PATH = os.getenv('SHARED_STORE_PATH', os.path.join('.cache', 'shared.sqlite3'))
+WARM_CACHE_CHAT_ID = os.getenv('WARM_CACHE_CHAT_ID')
+WARM_CACHE_CONCURRENCY = int(os.getenv('WARM_CACHE_CONCURRENCY', '4'))
+WARM_CACHE_PROFILES = os.getenv('WARM_CACHE_PROFILES', '3.0/1200/6.0,3.5/1350/6.5,3.8/1450/7.0,3.5/-/6.5,-/-/-')
 
 (GPA, COUNTRY, SAT, IELTS, ADDITIONAL_INFO, SHOWING_UNIVERSITIES, 
  UNIVERSITY_INFO, UNIVERSITY_QUESTIONS) = range(8)
 
-async def get_university_image(uni_name: str) -> BytesIO:
-    """Получает изображение университета через Google Custom Search API"""
+STATE_NAMES = {
+    GPA: 'gpa',
+    COUNTRY: 'country',
+    SAT: 'sat',
+    IELTS: 'ielts',
+    ADDITIONAL_INFO: 'additional_info',
+    SHOWING_UNIVERSITIES: 'showing_universities',
+    UNIVERSITY_INFO: 'university_info',
+    UNIVERSITY_QUESTIONS: 'university_questions'
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(2 ** power * 1024 for power in range(4, 14))
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Метрики процесса в текстовом формате Prometheus.
+
+    Все обновления идут из одного цикла событий, поэтому счетчики и гистограммы - обычные
+    словари без блокировок. Значения, которые уже считаются в других местах (статистика
+    кэшей, очередь отправки), собираются функциями-сборщиками только при чтении /metrics.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._meta = {}
+        self._series = {}
+        self._collectors = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = None) -> None:
+        self._meta[name] = (kind, help_text, buckets)
+        self._series.setdefault(name, {})
+
+    def collector(self, name: str, kind: str, help_text: str, func) -> None:
+        """Регистрирует сборщик: func() возвращает список пар (метки, значение)"""
+        self._meta[name] = (kind, help_text, None)
+        self._collectors[name] = func
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        series = self._series[name]
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        series = self._series[name]
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._meta[name][2])
+        histogram.observe(value)
+
+    def total(self, name: str) -> float:
+        """Сумма счетчика или число наблюдений гистограммы по всем меткам"""
+        return sum(
+            value.count if isinstance(value, Histogram) else value
+            for value in self._series.get(name, {}).values()
+        )
+
+    LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+    @staticmethod
+    def _format_labels(labels, extra: tuple = ()) -> str:
+        pairs = tuple(labels) + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{str(value).translate(Metrics.LABEL_ESCAPES)}"' for key, value in pairs) + '}'
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        if isinstance(value, float) and not value.is_integer():
+            return repr(value)
+        return str(int(value))
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._collectors:
+                try:
+                    samples = [(tuple(labels.items()), value) for labels, value in self._collectors[name]()]
+                except Exception as e:
+                    print(f"Error in metrics collector {name}: {str(e)}")
+                    samples = []
+            else:
+                samples = list(self._series[name].items())
+
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(value.sum)}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {value.count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(METRICS_ENABLED)
+metrics.describe('univi_handler_seconds', 'histogram', 'Время работы обработчиков диалога', LATENCY_BUCKETS)
+metrics.describe('univi_gemini_request_seconds', 'histogram', 'Время запросов к Gemini', LATENCY_BUCKETS)
+metrics.describe('univi_gemini_first_chunk_seconds', 'histogram', 'Время до первой части потокового ответа Gemini', LATENCY_BUCKETS)
+metrics.describe('univi_gemini_tokens', 'histogram', 'Число токенов в одном запросе к Gemini', TOKEN_BUCKETS)
+metrics.describe('univi_gemini_tokens_total', 'counter', 'Всего токенов Gemini')
+metrics.describe('univi_image_search_seconds', 'histogram', 'Время запросов к Custom Search', LATENCY_BUCKETS)
+metrics.describe('univi_image_download_seconds', 'histogram', 'Время скачивания изображений', LATENCY_BUCKETS)
+metrics.describe('univi_image_download_bytes', 'histogram', 'Размер скачанных изображений', BYTES_BUCKETS)
+metrics.describe('univi_telegram_request_seconds', 'histogram', 'Время запросов к Bot API', LATENCY_BUCKETS)
+metrics.describe('univi_telegram_queue_seconds', 'histogram', 'Ожидание в очереди отправки', LATENCY_BUCKETS)
+metrics.describe('univi_errors_total', 'counter', 'Ошибки по месту и типу')
+metrics.describe('univi_retries_total', 'counter', 'Повторы запросов к внешним сервисам')
+metrics.describe('univi_circuit_rejections_total', 'counter', 'Запросы, отклоненные разомкнутым предохранителем')
+metrics.describe('univi_circuit_opened_total', 'counter', 'Сколько раз размыкался предохранитель')
+metrics.describe('univi_hedged_requests_total', 'counter', 'Дублирующие запросы изображений')
+metrics.describe('univi_image_wait_timeouts_total', 'counter', 'Карточки, отправленные с заглушкой, не дождавшись изображения')
+
+
+def report_error(where: str, e: Exception, subject: str = None) -> None:
+    """Печатает ошибку и учитывает ее в счетчике ошибок"""
+    metrics.inc('univi_errors_total', where=where, type=type(e).__name__)
+    suffix = f" ({subject})" if subject else ''
+    print(f"Error in {where}{suffix}: {str(e)}")
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы: все вызывающие ждут одно выполнение.
+
+    Ошибка выполнения получают все ожидающие, но она не запоминается - следующий вызов
+    с тем же ключом выполнится заново. Выполнение отменяется, только если отменены все,
+    кто его ждет.
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+        self._calls = {}
+
+    def _forget(self, key, task) -> None:
+        call = self._calls.get(key)
+        if call is not None and call[0] is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func, *args):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = [asyncio.ensure_future(func(*args)), 0]
+            call[0].add_done_callback(functools.partial(self._forget, key))
+            self.stats['calls'] += 1
+        else:
+            self.stats['coalesced'] += 1
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1 and not call[0].done():
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float, fresh: bool = False):
+    """Ограничивает время всех внешних запросов внутри блока.
+
+    Вложенный срок не продлевает внешний; fresh=True отбрасывает внешний срок - для фоновых
+    задач, которые переживают запустивший их обработчик.
+    """
+    expires_at = time.monotonic() + seconds
+    current = None if fresh else request_deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = request_deadline.set(expires_at)
     try:
-        search_query = f"{uni_name} university campus main building"
-        
-        params = {
-            'key': GOOGLE_API_KEY,
-            'cx': CUSTOM_SEARCH_ENGINE_ID,
-            'q': search_query,
-            'searchType': 'image',
-            'imgSize': 'large',
-            'imgType': 'photo',
-            'num': 1 
-        }
-        
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def time_left(limit: float = math.inf) -> float:
+    """Сколько секунд можно потратить на запрос: не больше limit и не дольше срока текущего запроса"""
+    expires_at = request_deadline.get()
+    if expires_at is None:
+        return limit
+    return max(min(limit, expires_at - time.monotonic()), 0)
+
+
+def deadline_exceeded(e: BaseException) -> bool:
+    """Таймаут вызван истекшим сроком запроса, а не медленной зависимостью"""
+    # Таймеры цикла событий могут сработать чуть раньше срока, поэтому небольшой запас
+    return isinstance(e, asyncio.TimeoutError) and request_deadline.get() is not None and time_left() < 0.05
+
+
+class CircuitOpen(Exception):
+    """Предохранитель зависимости разомкнут, запрос не выполнялся"""
+
+
+class CircuitBreaker:
+    """Предохранитель внешней зависимости.
+
+    После failure_threshold ошибок подряд размыкается и reset_timeout секунд сразу отказывает,
+    затем пропускает один пробный запрос: успех замыкает его, ошибка снова размыкает.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def check(self) -> None:
+        """Бросает CircuitOpen, если запрос сейчас выполнять нельзя"""
+        if self.state == self.CLOSED:
+            return
+        if self.is_open() or (self.state == self.HALF_OPEN and self._probing):
+            metrics.inc('univi_circuit_rejections_total', dependency=self.name)
+            raise CircuitOpen(self.name)
+        self.state = self.HALF_OPEN
+        self._probing = True
+
+    def success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                metrics.inc('univi_circuit_opened_total', dependency=self.name)
+                print(f"Circuit {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Пробный запрос завершился без результата (отменен) - следующий сможет попробовать снова"""
+        self._probing = False
+
+
+circuit_breakers = {}
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(name)
+    if breaker is None:
+        breaker = circuit_breakers[name] = CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+    return breaker
+
+
+HTTP_TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+GEMINI_TRANSIENT_ERRORS = (google_exceptions.ServerError, google_exceptions.TooManyRequests, asyncio.TimeoutError)
+
+
+async def call_with_retries(breaker: CircuitBreaker, func, *args, transient=HTTP_TRANSIENT_ERRORS,
+                            attempts: int = RETRY_ATTEMPTS):
+    """Выполняет func через предохранитель, повторяя ее при временных ошибках.
+
+    Пауза перед повтором случайная, от 0 до RETRY_BASE_DELAY * 2^n (full jitter), чтобы
+    повторы разных запросов не совпадали. Если до срока запроса пауза не укладывается,
+    повтора нет.
+    """
+    for attempt in range(attempts):
+        if time_left() <= 0:
+            # Время вышло по вине обработчика, а не зависимости - предохранитель не трогаем
+            raise asyncio.TimeoutError()
+        breaker.check()
+        try:
+            result = await func(*args)
+        except transient as e:
+            if deadline_exceeded(e):
+                breaker.release()
+                raise
+            breaker.failure()
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if attempt + 1 >= attempts or breaker.is_open() or time_left() <= delay:
+                raise
+            metrics.inc('univi_retries_total', dependency=breaker.name)
+            await asyncio.sleep(delay)
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.success()
+            return result
+
+
+class GenerationCancelled(Exception):
+    """Генерация отменена пользователем (например, повторным /start)"""
+
+
+class LLMGateway:
+    """Асинхронные запросы к Gemini с ограничением числа одновременных генераций"""
+
+    def __init__(self, model, max_in_flight: int, timeout: float):
+        self.model = model
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._tasks = {}
+        self._cancelled = set()
+        self._flight = SingleFlight()
+        self._streams = {}
+        self.stats = Counter()
+        self.breaker = circuit_breaker('gemini')
+
+    @staticmethod
+    def _record(mode: str, started: float, outcome: str, usage=None) -> None:
+        metrics.observe('univi_gemini_request_seconds', time.perf_counter() - started, mode=mode, outcome=outcome)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        completion_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        metrics.inc('univi_gemini_tokens_total', prompt_tokens, kind='prompt')
+        metrics.inc('univi_gemini_tokens_total', completion_tokens, kind='completion')
+        metrics.observe('univi_gemini_tokens', prompt_tokens + completion_tokens, mode=mode)
+
+    @staticmethod
+    def _outcome(e: BaseException) -> str:
+        if isinstance(e, asyncio.CancelledError):
+            return 'cancelled'
+        if isinstance(e, asyncio.TimeoutError):
+            return 'timeout'
+        return 'error'
+
+    async def _attempt(self, prompt: str):
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(prompt),
+                timeout=time_left(self.timeout)
+            )
+        except BaseException as e:
+            self._record('generate', started, self._outcome(e))
+            raise
+        self._record('generate', started, 'ok', getattr(response, 'usage_metadata', None))
+        return response
+
+    async def _generate(self, prompt: str) -> str:
+        async with self._semaphore:
+            response = await call_with_retries(self.breaker, self._attempt, prompt, transient=GEMINI_TRANSIENT_ERRORS)
+        return response.text
+
+    async def _open_stream(self, prompt: str):
+        return await asyncio.wait_for(
+            self.model.generate_content_async(prompt, stream=True),
+            timeout=time_left(self.timeout)
+        )
+
+    def _end_stream(self, key: str, call: list, item) -> None:
+        if self._streams.get(key) is call:
+            del self._streams[key]
+        for queue in call[2]:
+            queue.put_nowait(item)
+
+    async def _produce(self, prompt: str, key: str, call: list) -> None:
+        chunks, queues = call[1], call[2]
+        started = None
+        usage = None
+        response = None
+        first_chunk = True
+        try:
+            async with self._semaphore:
+                started = time.perf_counter()
+                # Повторять можно только до первой части ответа - дальше пользователь уже видит текст
+                response = await call_with_retries(
+                    self.breaker, self._open_stream, prompt, transient=GEMINI_TRANSIENT_ERRORS
+                )
+                async for chunk in response:
+                    if first_chunk:
+                        metrics.observe('univi_gemini_first_chunk_seconds', time.perf_counter() - started)
+                        first_chunk = False
+                    # В потоке каждая часть несет накопленный счетчик токенов
+                    usage = getattr(chunk, 'usage_metadata', None) or usage
+                    if chunk.parts:
+                        chunks.append(chunk.text)
+                        for queue in queues:
+                            queue.put_nowait(chunk.text)
+            self._record('stream', started, 'ok', usage)
+            self._end_stream(key, call, None)
+        except BaseException as e:
+            if started is not None:
+                self._record('stream', started, self._outcome(e))
+            if response is not None and isinstance(e, GEMINI_TRANSIENT_ERRORS) and not deadline_exceeded(e):
+                # Обрыв уже открытого потока call_with_retries не видит
+                self.breaker.failure()
+            self._end_stream(key, call, e)
+            raise
+
+    def _track(self, chat_id, task) -> None:
+        if chat_id is not None:
+            self._tasks.setdefault(chat_id, set()).add(task)
+
+    def _untrack(self, chat_id, task) -> None:
+        self._cancelled.discard(task)
+        chat_tasks = self._tasks.get(chat_id)
+        if chat_tasks is not None:
+            chat_tasks.discard(task)
+            if not chat_tasks:
+                del self._tasks[chat_id]
+
+    async def generate(self, prompt: str, chat_id=None) -> str:
+        """Генерирует ответ, не блокируя цикл событий; одинаковые запросы выполняются один раз"""
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        task = asyncio.ensure_future(self._flight.do(key, self._generate, prompt))
+        self._track(chat_id, task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self._cancelled:
+                raise GenerationCancelled()
+            task.cancel()
+            raise
+        finally:
+            self._untrack(chat_id, task)
+
+    async def stream(self, prompt: str, chat_id=None):
+        """Генерирует ответ по частям по мере их поступления от модели.
+
+        Одинаковые запросы, как и в generate, выполняются один раз: части ответа получают
+        все слушатели, а присоединившийся позже сначала получает уже пришедшие. Генерация
+        отменяется, только когда ее перестали слушать все.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + time_left(self.timeout)
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        call = self._streams.get(key)
+        if call is None:
+            call = self._streams[key] = [None, [], []]
+            call[0] = asyncio.ensure_future(self._produce(prompt, key, call))
+            call[0].add_done_callback(lambda task: task.cancelled() or task.exception())
+        else:
+            self.stats['coalesced_streams'] += 1
+
+        queue = asyncio.Queue()
+        for chunk in call[1]:
+            queue.put_nowait(chunk)
+        call[2].append(queue)
+        # Отмена для чата (cancel) снимает только этого слушателя, остальные получают ответ дальше
+        listener = loop.create_future()
+        listener.add_done_callback(lambda future: future.cancelled() and queue.put_nowait(asyncio.CancelledError()))
+        self._track(chat_id, listener)
+        try:
+            while True:
+                item = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                if item is None:
+                    return
+                if isinstance(item, asyncio.CancelledError) and listener in self._cancelled:
+                    raise GenerationCancelled()
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            call[2].remove(queue)
+            if not call[2] and not call[0].done():
+                # Новые одинаковые запросы не должны присоединяться к отменяемой генерации
+                if self._streams.get(key) is call:
+                    del self._streams[key]
+                call[0].cancel()
+            if not listener.done():
+                listener.set_result(None)
+            self._untrack(chat_id, listener)
+
+    def cancel(self, chat_id) -> int:
+        """Отменяет все генерации, запущенные для чата"""
+        tasks = [task for task in self._tasks.get(chat_id, ()) if not task.done()]
+        for task in tasks:
+            self._cancelled.add(task)
+            task.cancel()
+        return len(tasks)
+
+
+# Лимит общий для бота, поэтому при нескольких процессах он делится между ними
+llm = LLMGateway(model, max(GEMINI_MAX_IN_FLIGHT // WORKERS, 1), GEMINI_TIMEOUT)
+
+http_session = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию приложения (создает при первом обращении)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return http_session
+
+
+async def open_http_session(application: Application) -> None:
+    get_http_session()
+
+
+async def close_http_session(application: Application) -> None:
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+def normalize_university_name(uni_name: str) -> str:
+    """Приводит название университета к виду, пригодному для ключа кэша"""
+    name = re.sub(r'[\W_]+', ' ', uni_name.casefold())
+    return ' '.join(name.split())
+
+
+class LRUCache:
+    """LRU-кэш с ограничением размера и временем жизни записей"""
+
+    def __init__(self, maxsize: float, ttl: float = None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        value, expires_at, size = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.maxsize:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires_at, size)
+        self.size += size
+
+        while self.size > self.maxsize:
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.size -= item[2]
+        return item[0]
+
+    def prune(self) -> int:
+        """Удаляет истекшие записи из начала очереди, возвращает их число"""
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            key, (_, expires_at, _) = next(iter(self._data.items()))
+            if expires_at is None or expires_at > now:
+                break
+            self.pop(key)
+            removed += 1
+        return removed
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size = 0
+
+
+class SharedStore:
+    """Хранилище ключ-значение в SQLite (WAL), общее для всех процессов бота.
+
+    Используется вторым уровнем за кэшами в памяти, чтобы результат, полученный одним
+    процессом, был виден остальным. Значения хранятся в JSON, истекшие записи считаются
+    отсутствующими и периодически удаляются.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, enabled: bool):
+        self.path = path
+        self.enabled = enabled
+        self.stats = Counter()
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-store')
+        self._writes = 0
+
+    @property
+    def readable(self) -> bool:
+        """Выключенное хранилище все равно читается, если его файл заполнил прогрев кэшей"""
+        return self.enabled or os.path.exists(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (namespace, key)
+                );
+            """)
+        return self._connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _get(self, namespace: str, key: str):
+        row = self._connect().execute(
+            'SELECT value FROM entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, namespace: str, key: str, value: str, expires_at) -> None:
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, value, expires_at)
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                connection.execute('DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+
+    def _delete(self, namespace: str, key: str) -> None:
+        connection = self._connect()
+        with connection:
+            connection.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+
+    async def get(self, namespace: str, key: str, default=None):
+        if not self.readable:
+            return default
+        try:
+            value = await self._run(self._get, namespace, key)
+        except sqlite3.Error as e:
+            report_error('shared_store', e, namespace)
+            return default
+        if value is None:
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        return json.loads(value)
+
+    async def set(self, namespace: str, key: str, value, ttl: float = None) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        try:
+            await self._run(self._set, namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+        except sqlite3.Error as e:
+            report_error('shared_store', e, namespace)
+
+    async def delete(self, namespace: str, key: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            await self._run(self._delete, namespace, key)
+        except sqlite3.Error as e:
+            report_error('shared_store', e, namespace)
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+
+
+shared_store = SharedStore(SHARED_STORE_PATH, SHARED_STORE_ENABLED)
+
+
+class ImageCache:
+    """Двухуровневый кэш изображений: LRU в памяти и контентно-адресуемое хранилище на диске.
+
+    Университеты без изображения запоминаются на miss_ttl секунд, чтобы не искать их заново.
+    """
+
+    # Значение записи-промаха и сколько памяти за нее учитывать
+    MISSING = b''
+    MISSING_SIZE = 256
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int, ttl: float, miss_ttl: float):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.memory = LRUCache(memory_bytes, ttl=ttl, sizeof=lambda data: len(data) or self.MISSING_SIZE)
+        self.stats = Counter()
+        self._disk_usage = None
+        self._blobs_dir = os.path.join(directory, 'blobs')
+        self._index_dir = os.path.join(directory, 'index')
+
+    @staticmethod
+    def _key(uni_name: str) -> str:
+        return normalize_university_name(uni_name)
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(self._index_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blobs_dir, digest + '.img')
+
+    def _read_disk(self, key: str):
+        index_path = self._index_path(key)
+        try:
+            with open(index_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            if self._expired(entry):
+                os.remove(index_path)
+                return None
+            if entry['digest'] is None:
+                return self.MISSING
+            blob_path = self._blob_path(entry['digest'])
+            with open(blob_path, 'rb') as f:
+                data = f.read()
+            os.utime(blob_path)
+            return data
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _expired(self, entry: dict) -> bool:
+        ttl = self.ttl if entry['digest'] is not None else self.miss_ttl
+        return time.time() - entry['created'] > ttl
+
+    def _write_index(self, key: str, digest) -> None:
+        os.makedirs(self._index_dir, exist_ok=True)
+        tmp_path = f"{self._index_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'digest': digest, 'created': time.time()}, f)
+        os.replace(tmp_path, self._index_path(key))
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        os.makedirs(self._blobs_dir, exist_ok=True)
+
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            # Каталог может быть общим для нескольких процессов
+            tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, blob_path)
+            if self._disk_usage is not None:
+                self._disk_usage += len(data)
+
+        self._write_index(key, digest)
+
+        if self._disk_usage is None:
+            self._disk_usage = sum(entry.stat().st_size for entry in os.scandir(self._blobs_dir))
+        if self._disk_usage > self.disk_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Удаляет давно не использованные файлы, пока кэш не уложится в 90% лимита"""
+        blobs = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self._blobs_dir)
+        )
+        usage = sum(size for _, size, _ in blobs)
+        for _, size, path in blobs:
+            if usage <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                usage -= size
+                self.stats['disk_evictions'] += 1
+            except OSError:
+                pass
+        self._disk_usage = usage
+
+        # Вместе с файлами удаляются и указывающие на них записи индекса, а заодно истекшие
+        for entry in os.scandir(self._index_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path, encoding='utf-8') as f:
+                    index = json.load(f)
+                orphaned = index['digest'] is not None and not os.path.exists(self._blob_path(index['digest']))
+                if orphaned or self._expired(index):
+                    os.remove(entry.path)
+            except (OSError, ValueError, KeyError):
+                pass
+
+    async def get(self, uni_name: str):
+        key = self._key(uni_name)
+        data = self.memory.get(key)
+        if data is not None:
+            self.stats['memory_hits'] += 1
+            return data
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self._read_disk, key)
+        if data is not None:
+            self.stats['disk_hits'] += 1
+            self.memory.set(key, data)
+            return data
+
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, uni_name: str, data: bytes) -> None:
+        key = self._key(uni_name)
+        self.memory.set(key, data)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write_disk, key, data)
+        except OSError as e:
+            report_error('image_cache', e)
+
+    async def put_missing(self, uni_name: str) -> None:
+        """Запоминает, что изображения университета не нашлось"""
+        key = self._key(uni_name)
+        self.memory.set(key, self.MISSING, ttl=self.miss_ttl)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write_index, key, None)
+        except OSError as e:
+            report_error('image_cache', e)
+
+
+image_cache = ImageCache(
+    IMAGE_CACHE_DIR,
+    int(IMAGE_CACHE_MEMORY_MB * 1024 * 1024),
+    int(IMAGE_CACHE_DISK_MB * 1024 * 1024),
+    IMAGE_CACHE_TTL,
+    IMAGE_MISS_TTL
+)
+
+
+class FileIdStore:
+    """Хранит file_id уже загруженных в Telegram изображений университетов"""
+
+    PLACEHOLDER_KEY = '__placeholder__'
+
+    def __init__(self, path: str, shared: SharedStore):
+        self.path = path
+        self.shared = shared
+        self.stats = Counter()
+        self._file_ids = {}
+        # Сохранения идут по одному: у процесса один временный файл
+        self._save_lock = asyncio.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._file_ids = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _key(uni_name) -> str:
+        return uni_name if uni_name == FileIdStore.PLACEHOLDER_KEY else normalize_university_name(uni_name)
+
+    def get(self, uni_name: str):
+        return self._file_ids.get(self._key(uni_name))
+
+    async def lookup(self, uni_name: str):
+        """Как get, но при промахе проверяет и общее хранилище других процессов"""
+        key = self._key(uni_name)
+        file_id = self._file_ids.get(key)
+        if file_id is None and self.shared.readable:
+            file_id = await self.shared.get('file_ids', key)
+            if file_id is not None:
+                self._file_ids[key] = file_id
+        return file_id
+
+    async def set(self, uni_name: str, file_id: str) -> None:
+        key = self._key(uni_name)
+        self._file_ids[key] = file_id
+        if self.shared.enabled:
+            await self.shared.set('file_ids', key, file_id)
+        await self._save()
+
+    async def discard(self, uni_name: str) -> None:
+        key = self._key(uni_name)
+        if self._file_ids.pop(key, None) is not None:
+            if self.shared.enabled:
+                await self.shared.delete('file_ids', key)
+            await self._save()
+
+    def _write(self, snapshot: dict) -> None:
+        # Файл пишется и при общем хранилище, чтобы file_id не терялись при переходе на один
+        # процесс; процессы перезаписывают файл своими снимками, полный набор - в общем хранилище
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def _save(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._save_lock:
+                await loop.run_in_executor(None, self._write, dict(self._file_ids))
+        except OSError as e:
+            report_error('file_id_store', e)
+
+
+file_id_store = FileIdStore(FILE_ID_STORE_PATH, shared_store)
+
+
+image_flight = SingleFlight()
+
+
+async def get_university_image_bytes(uni_name: str):
+    """Возвращает байты изображения университета из кэша или из сети, None - если не найдено"""
+    return await image_flight.do(normalize_university_name(uni_name), load_university_image_bytes, uni_name)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get('https://www.googleapis.com/customsearch/v1', params=params) as response:
-                data = await response.json()
-                
-                if 'items' in data and len(data['items']) > 0:
-                    image_url = data['items'][0]['link']
-                    
 
-                    async with session.get(image_url) as img_response:
-                        if img_response.status == 200:
-                            img_data = await img_response.read()
-                            return BytesIO(img_data)
-                
+async def load_university_image_bytes(uni_name: str):
+    cached = await image_cache.get(uni_name)
+    if cached == ImageCache.MISSING:
+        return None
+    if cached is not None:
+        return cached
 
+    img_data = await fetch_university_image(uni_name)
+    if img_data is not None:
+        await image_cache.put(uni_name, img_data)
+    return img_data
+
+
+async def get_university_image(uni_name: str) -> BytesIO:
+    """Получает изображение университета из кэша или через Google Custom Search API"""
+    img_data = await get_university_image_bytes(uni_name)
+    if img_data is None:
         return get_placeholder_image()
-        
+    return BytesIO(img_data)
+
+
+async def send_photo_by_file_id(bot, chat_id, store_key: str, **kwargs):
+    """Отправляет фото по сохраненному file_id, None - если file_id нет или Telegram его отклонил"""
+    file_id = await file_id_store.lookup(store_key)
+    if not file_id:
+        file_id_store.stats['misses'] += 1
+        return None
+    try:
+        message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        file_id_store.stats['hits'] += 1
+        return message
+    except BadRequest as e:
+        file_id_store.stats['misses'] += 1
+        report_error('send_photo_by_file_id', e, store_key)
+        await file_id_store.discard(store_key)
+        return None
+
+
+def prefetch_university_image(uni_name: str):
+    """Запускает фоновую загрузку изображения, если для него еще нет сохраненного file_id"""
+    if file_id_store.get(uni_name):
+        return None
+    return asyncio.ensure_future(get_university_image_bytes(uni_name))
+
+
+async def send_university_photo(bot, chat_id, uni_name: str, image_task=None, **kwargs):
+    """Отправляет фото университета по сохраненному file_id, а при его отсутствии - загружает"""
+    message = await send_photo_by_file_id(bot, chat_id, uni_name, **kwargs)
+    if message is not None:
+        return message
+
+    if image_task is None:
+        image_task = asyncio.ensure_future(get_university_image_bytes(uni_name))
+    try:
+        # Карточка не ждет медленное изображение дольше IMAGE_WAIT_TIMEOUT: загрузка продолжится
+        # в фоне и попадет в кэш, а сейчас уйдет заглушка
+        img_data = await asyncio.wait_for(asyncio.shield(image_task), timeout=time_left(IMAGE_WAIT_TIMEOUT))
+    except asyncio.TimeoutError:
+        metrics.inc('univi_image_wait_timeouts_total')
+        img_data = None
+    store_key = uni_name
+    if img_data is None:
+        store_key = FileIdStore.PLACEHOLDER_KEY
+        message = await send_photo_by_file_id(bot, chat_id, store_key, **kwargs)
+        if message is not None:
+            return message
+        photo = get_placeholder_image()
+    else:
+        photo = BytesIO(img_data)
+
+    message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    if message.photo:
+        await file_id_store.set(store_key, message.photo[-1].file_id)
+    return message
+
+
+def http_timeout() -> aiohttp.ClientTimeout:
+    """Таймаут HTTP-запроса с учетом срока текущего запроса"""
+    return aiohttp.ClientTimeout(total=max(time_left(HTTP_TOTAL_TIMEOUT), 0.01), connect=HTTP_CONNECT_TIMEOUT)
+
+
+async def fetch_university_image(uni_name: str):
+    """Ищет и скачивает изображение университета, возвращает байты или None"""
+    try:
+        session = get_http_session()
+        image_url = await call_with_retries(circuit_breaker('search'), search_image_url, session, uni_name)
+        raw_data = None
+        if image_url is not None:
+            raw_data = await download_image_hedged(session, image_url)
+        if raw_data is None:
+            # Не искать его снова при каждом показе карточки; отказы сервисов не запоминаются
+            await image_cache.put_missing(uni_name)
+            return None
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(image_executor, normalize_image, raw_data)
+
+    except CircuitOpen:
+        # Сервис недоступен - сразу отдаем заглушку, отказ уже учтен в метриках
+        return None
     except Exception as e:
-        print(f"Error fetching image: {str(e)}")
-        return get_placeholder_image()
+        report_error('fetch_university_image', e, uni_name)
+        return None
 
-def get_placeholder_image() -> BytesIO:
+
+async def search_image_url(session: aiohttp.ClientSession, uni_name: str):
+    """Ищет через Custom Search ссылку на фото кампуса, None - если ничего не нашлось"""
+    params = {
+        'key': GOOGLE_API_KEY,
+        'cx': CUSTOM_SEARCH_ENGINE_ID,
+        'q': f"{uni_name} university campus main building",
+        'searchType': 'image',
+        'imgSize': 'large',
+        'imgType': 'photo',
+        'num': 1
+    }
+    started = time.perf_counter()
+    async with session.get(CUSTOM_SEARCH_URL, params=params, timeout=http_timeout()) as response:
+        metrics.observe('univi_image_search_seconds', time.perf_counter() - started, status=response.status)
+        # Перегрузку и ошибки сервера стоит повторить, остальное - нет
+        if response.status == 429 or response.status >= 500:
+            response.raise_for_status()
+        data = await response.json()
+
+    items = data.get('items') or []
+    return items[0]['link'] if items else None
+
+
+class LatencyWindow:
+    """Длительности последних запросов для оценки перцентиля"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+
+    def add(self, value: float) -> None:
+        self._values.append(value)
+
+    def percentile(self, q: float):
+        """q-й перцентиль или None, пока замеров слишком мало"""
+        if len(self._values) < self.MIN_SAMPLES:
+            return None
+        values = sorted(self._values)
+        return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+image_download_latency = LatencyWindow()
+
+
+async def download_image_hedged(session: aiohttp.ClientSession, image_url: str):
+    """Скачивает изображение; если загрузка дольше обычного, параллельно запускает повторную.
+
+    Повторный запрос уходит, когда первый длится дольше IMAGE_HEDGE_PERCENTILE-го перцентиля
+    недавних загрузок; берется ответ, пришедший первым, второй запрос отменяется.
+    """
+    # Один предохранитель на все сайты: по отдельному на каждый хост, который вернет поиск,
+    # число предохранителей и меток в метриках росло бы без ограничений
+    breaker = circuit_breaker('images')
+    primary = asyncio.ensure_future(call_with_retries(breaker, download_image, session, image_url))
+    hedge_delay = image_download_latency.percentile(IMAGE_HEDGE_PERCENTILE) if IMAGE_HEDGE_PERCENTILE else None
+    if hedge_delay is None:
+        return await primary
+
+    hedge = None
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=max(hedge_delay, IMAGE_HEDGE_MIN_DELAY))
+        if not done and time_left() > 0:
+            hedge = asyncio.ensure_future(call_with_retries(breaker, download_image, session, image_url, attempts=1))
+            pending.add(hedge)
+            metrics.inc('univi_hedged_requests_total', outcome='sent')
+
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        metrics.inc('univi_hedged_requests_total', outcome='won')
+                    return task.result()
+            if not pending:
+                return primary.result()
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def download_image(session: aiohttp.ClientSession, image_url: str):
+    """Скачивает изображение по частям, прерывая загрузку при превышении лимита размера"""
+    max_bytes = int(IMAGE_MAX_DOWNLOAD_MB * 1024 * 1024)
+    started = time.perf_counter()
+    async with session.get(image_url, timeout=http_timeout()) as img_response:
+        if img_response.status == 429 or img_response.status >= 500:
+            img_response.raise_for_status()
+        if img_response.status != 200:
+            return None
+        if img_response.content_length and img_response.content_length > max_bytes:
+            print(f"Image too large ({img_response.content_length} bytes): {image_url}")
+            return None
+
+        chunks = []
+        size = 0
+        async for chunk in img_response.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                print(f"Image exceeds {max_bytes} bytes: {image_url}")
+                return None
+            chunks.append(chunk)
+        elapsed = time.perf_counter() - started
+        image_download_latency.add(elapsed)
+        metrics.observe('univi_image_download_seconds', elapsed)
+        metrics.observe('univi_image_download_bytes', size)
+        return b''.join(chunks)
+
+
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='images')
+
+
+def normalize_image(data: bytes):
+    """Уменьшает изображение до IMAGE_MAX_SIDE и пережимает в JPEG; None - если это не картинка"""
+    try:
+        img = Image.open(BytesIO(data))
+        # Для JPEG декодируем сразу в уменьшенном масштабе - это намного быстрее
+        img.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+        return output.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error normalizing image: {str(e)}")
+        return None
+
+
+def build_placeholder_image() -> bytes:
     """Создает изображение-заглушку"""
     img = Image.new('RGB', (800, 400), color='white')
     img_byte_arr = BytesIO()
     img.save(img_byte_arr, format='JPEG')
-    img_byte_arr.seek(0)
-    return img_byte_arr
+    return img_byte_arr.getvalue()
+
+
+PLACEHOLDER_IMAGE = build_placeholder_image()
+
+
+def get_placeholder_image() -> BytesIO:
+    """Возвращает изображение-заглушку, собранное один раз при запуске"""
+    return BytesIO(PLACEHOLDER_IMAGE)
 
 
 
@@ -82,6 +1374,468 @@ def clean_json_string(s: str) -> str:
     json_str = re.sub(r'```json\s*', '', json_str)
     json_str = re.sub(r'```', '', json_str)
     return json_str
+
+
+class UniversityStreamParser:
+    """Инкрементальный разбор ответа модели: отдает каждый объект из "universities",
+    как только пришла его закрывающая скобка.
+
+    Текст вокруг JSON и markdown-ограждения пропускаются; если массив так и не нашелся,
+    finish() разбирает весь ответ целиком, как раньше.
+    """
+
+    ARRAY_START = re.compile(r'"universities"\s*:\s*\[')
+    TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+    def __init__(self):
+        self.buffer = ''
+        self.emitted = 0
+        self._pos = None
+        self._depth = 0
+        self._start = None
+        self._in_string = False
+        self._escape = False
+        self._done = False
+
+    def _decode(self, text: str):
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+        try:
+            return json.loads(self.TRAILING_COMMA.sub(r'\1', text))
+        except ValueError as e:
+            report_error('UniversityStreamParser', e)
+            return None
+
+    def feed(self, chunk: str) -> list:
+        """Добавляет часть ответа и возвращает университеты, которые в ней завершились"""
+        self.buffer += chunk
+        if self._done:
+            return []
+        if self._pos is None:
+            match = self.ARRAY_START.search(self.buffer)
+            if match is None:
+                return []
+            self._pos = match.end()
+
+        universities = []
+        buffer = self.buffer
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 0 and char == '{':
+                    self._start = i
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth < 0:
+                    self._done = True
+                    break
+                if self._depth == 0 and char == '}' and self._start is not None:
+                    uni = self._decode(buffer[self._start:i + 1])
+                    self._start = None
+                    if isinstance(uni, dict):
+                        universities.append(uni)
+        self._pos = len(buffer)
+        self.emitted += len(universities)
+        return universities
+
+    def finish(self) -> list:
+        """Возвращает университеты, которые не удалось отдать по ходу потока"""
+        if self.emitted:
+            return []
+        return json.loads(clean_json_string(self.buffer.strip())).get('universities', [])
+
+
+QUESTION_STOPWORDS = frozenset("""
+а в во да же за и или из к ко ли мне мной на ну о об от по при про то у
+что как какой какая какое какие каков какова каково каковы где когда сколько есть
+ваш ваша ваше ваши вы мой моя мое мои я мы он она они это этот эта эти там тут
+можно нужно нужен нужна нужны бы был была были будет будут
+подскажите скажите расскажите пожалуйста университет университете университета вуз вузе
+a an the is are was were be do does did of in on at to for and or what how which
+where when can could would should i you we it this that there about please tell me
+university
+""".split())
+
+# Отрицания и предлоги "с"/"без" меняют смысл вопроса: они остаются в токенах и должны совпадать
+QUESTION_POLARITY_WORDS = frozenset('не нет ни без с со not no without with'.split())
+
+
+def normalize_question(question: str) -> frozenset:
+    """Приводит вопрос к множеству значимых слов для поиска в кэше ответов"""
+    words = re.findall(r'\w+', question.casefold().replace('ё', 'е'))
+    # Грубый стемминг: отбрасываем окончания, чтобы "общежитие" и "общежития" совпадали
+    return frozenset(word[:6] for word in words if word not in QUESTION_STOPWORDS)
+
+
+class AnswerCache:
+    """Кэш ответов на вопросы об университетах с поиском похожих формулировок"""
+
+    def __init__(self, maxsize: int, ttl: float, similarity: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._by_uni = {}
+
+    @staticmethod
+    def shared_key(uni_id: str, question: str) -> str:
+        """Ключ точного совпадения для общего хранилища, пустой - если в вопросе нет значимых слов"""
+        tokens = normalize_question(question)
+        return f"{uni_id}:{' '.join(sorted(tokens))}" if tokens else ''
+
+    def _remove(self, entry_key) -> None:
+        del self._entries[entry_key]
+        uni_id, key = entry_key
+        keys = self._by_uni[uni_id]
+        keys.discard(key)
+        if not keys:
+            del self._by_uni[uni_id]
+
+    def _lookup(self, entry_key):
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            self._remove(entry_key)
+            return None
+        self._entries.move_to_end(entry_key)
+        return entry
+
+    def get(self, uni_id: str, question: str):
+        tokens = normalize_question(question)
+        if not tokens:
+            self.stats['misses'] += 1
+            return None
+
+        entry = self._lookup((uni_id, ' '.join(sorted(tokens))))
+        if entry is None and self.similarity < 1:
+            best_key, best_score = None, self.similarity
+            for key in list(self._by_uni.get(uni_id, ())):
+                cached_tokens = self._entries[(uni_id, key)][0]
+                if tokens & QUESTION_POLARITY_WORDS != cached_tokens & QUESTION_POLARITY_WORDS:
+                    continue
+                score = len(tokens & cached_tokens) / len(tokens | cached_tokens)
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is not None:
+                entry = self._lookup((uni_id, best_key))
+                if entry is not None:
+                    self.stats['near_hits'] += 1
+
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.stats['llm_calls_avoided'] += 1
+        return entry[1]
+
+    def set(self, uni_id: str, question: str, answer: str) -> None:
+        tokens = normalize_question(question)
+        if not tokens or not answer:
+            return
+
+        key = ' '.join(sorted(tokens))
+        if (uni_id, key) in self._entries:
+            self._remove((uni_id, key))
+        self._entries[(uni_id, key)] = (tokens, answer, time.monotonic() + self.ttl)
+        self._by_uni.setdefault(uni_id, set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: около четырех символов на токен"""
+    return len(text) // 4 + 1
+
+
+class FrozenRecord(Mapping):
+    """Неизменяемый компактный словарь: ключи и значения хранятся в двух кортежах.
+
+    Записи с одинаковым набором полей делят один кортеж ключей, строки интернируются,
+    вложенные словари и списки замораживаются в FrozenRecord и кортежи.
+    """
+
+    __slots__ = ('_keys', '_values')
+
+    _key_sets = {}
+
+    def __init__(self, data: dict):
+        keys = tuple(sys.intern(str(key)) for key in data)
+        self._keys = FrozenRecord._key_sets.setdefault(keys, keys)
+        self._values = tuple(freeze(value) for value in data.values())
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __repr__(self) -> str:
+        return f"FrozenRecord({dict(self)!r})"
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenRecord(value)
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def thaw(value):
+    """Обратное преобразование в обычные словари и списки (для JSON)"""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def university_digest(uni: Mapping) -> str:
+    """Сжатое текстовое описание университета для контекста модели (без JSON-разметки)"""
+    lines = []
+
+    def walk(prefix, value):
+        if isinstance(value, Mapping):
+            for key, item in value.items():
+                walk(f"{prefix}.{key}" if prefix else key, item)
+        elif isinstance(value, (list, tuple)):
+            if value:
+                lines.append(f"{prefix}: {', '.join(str(item) for item in value)}")
+        elif value not in (None, ''):
+            lines.append(f"{prefix}: {value}")
+
+    walk('', uni)
+    return '\n'.join(lines)
+
+
+class QASession:
+    """Диалог пользователя об одном университете: контекст, краткое содержание и последние ходы"""
+
+    __slots__ = ('uni_name', 'context', 'summary', 'turns', 'compacting')
+
+    def __init__(self, uni_id: str, uni: Mapping):
+        self.uni_name = uni['name']
+        # Описание одного университета общее для всех сессий
+        self.context = university_store.view(uni_id, uni, 'digest')
+        self.summary = ''
+        self.turns = []
+        self.compacting = None
+
+    def history_tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(
+            estimate_tokens(question) + estimate_tokens(answer) for question, answer in self.turns
+        )
+
+    def build_prompt(self, question: str) -> str:
+        parts = [
+            f"Ты консультант по поступлению в {self.uni_name}. "
+            f"Отвечай на вопросы студента, опираясь на сведения об университете и предыдущий разговор.",
+            f"Сведения об университете:\n{self.context}"
+        ]
+        if self.summary:
+            parts.append(f"Краткое содержание предыдущего разговора:\n{self.summary}")
+        if self.turns:
+            parts.append("Последние вопросы и ответы:\n" + '\n'.join(
+                f"Студент: {turn_question}\nКонсультант: {turn_answer}" for turn_question, turn_answer in self.turns
+            ))
+        parts.append(f"Новый вопрос студента:\n{question}")
+        parts.append(
+            "Дай максимально подробный и полезный ответ на вопрос студента, "
+            "включая конкретные факты, цифры и рекомендации где это уместно."
+        )
+        return '\n\n'.join(parts)
+
+
+class QASessionStore:
+    """Сессии вопросов об университетах по паре (пользователь, университет).
+
+    Gemini не хранит состояние между запросами, поэтому сессия живет в боте: сведения
+    об университете сжимаются в текст один раз, а история ограничена числом ходов и
+    бюджетом токенов. Старые ходы сворачиваются моделью в краткое содержание в фоне
+    (или просто отбрасываются), неактивные сессии вытесняются через QA_SESSION_IDLE_TTL.
+    """
+
+    KEEP_TURNS = 2
+
+    def __init__(self, maxsize: int, idle_ttl: float, max_turns: int, token_budget: int, summarize: bool):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.stats = Counter()
+        self._sessions = LRUCache(maxsize, ttl=idle_ttl)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, user_id, uni_id: str, uni: Mapping) -> QASession:
+        """Возвращает сессию пользователя для университета, создавая ее при необходимости"""
+        self.stats['evicted'] += self._sessions.prune()
+        key = (user_id, uni_id)
+        session = self._sessions.get(key)
+        if session is None:
+            session = QASession(uni_id, uni)
+            self.stats['created'] += 1
+        # Повторная запись продлевает время жизни сессии
+        self._sessions.set(key, session)
+        return session
+
+    def drop(self, user_id, uni_id: str) -> None:
+        session = self._sessions.pop((user_id, uni_id))
+        if session is not None and session.compacting is not None:
+            session.compacting.cancel()
+
+    def record(self, session: QASession, question: str, answer: str) -> None:
+        """Добавляет ход в историю и при превышении бюджета сворачивает старые ходы"""
+        session.turns.append((question, answer))
+        if len(session.turns) > self.max_turns:
+            del session.turns[:len(session.turns) - self.max_turns]
+            self.stats['truncated'] += 1
+
+        if session.history_tokens() <= self.token_budget or session.compacting is not None:
+            return
+        if self.summarize and len(session.turns) > self.KEEP_TURNS:
+            session.compacting = asyncio.ensure_future(self._compact(session))
+            return
+
+        while len(session.turns) > 1 and session.history_tokens() > self.token_budget:
+            session.turns.pop(0)
+            self.stats['truncated'] += 1
+
+    async def _compact(self, session: QASession) -> None:
+        old_turns = session.turns[:-self.KEEP_TURNS]
+        dialogue = '\n'.join(f"Студент: {question}\nКонсультант: {answer}" for question, answer in old_turns)
+        previous = f"Прежнее краткое содержание:\n{session.summary}" if session.summary else ''
+        prompt = f"""
+        Сожми разговор студента с консультантом по поступлению в {session.uni_name} в 3-5 предложений.
+        Сохрани факты, цифры и то, что студент рассказал о себе.
+
+        {previous}
+
+        Разговор:
+        {dialogue}
+        """
+        # Пока идет сжатие, история может сдвинуться, поэтому убираем именно эти ходы
+        summarized = {id(turn) for turn in old_turns}
+        try:
+            session.summary = (await llm.generate(prompt)).strip()
+            self.stats['summarized'] += 1
+        except Exception as e:
+            report_error('qa_session_summary', e)
+            self.stats['truncated'] += 1
+        finally:
+            session.turns = [turn for turn in session.turns if id(turn) not in summarized]
+            session.compacting = None
+
+
+qa_sessions = QASessionStore(
+    QA_SESSION_MAX,
+    QA_SESSION_IDLE_TTL,
+    QA_SESSION_MAX_TURNS,
+    QA_SESSION_TOKEN_BUDGET,
+    QA_SESSION_SUMMARIZE
+)
+
+
+def markdown_safe_prefix(text: str) -> str:
+    """Обрезает частичный ответ до последнего места, где все Markdown-сущности закрыты"""
+    closing = None
+    safe_end = 0
+    i = 0
+    while i < len(text):
+        if closing is None:
+            if text[i] == '\\':
+                i += 2
+            elif text.startswith('```', i):
+                closing, i = '```', i + 3
+            elif text[i] in '*_`':
+                closing, i = text[i], i + 1
+            elif text[i] == '[':
+                closing, i = ')', i + 1
+            else:
+                i += 1
+        elif text.startswith(closing, i):
+            closing, i = None, i + len(closing)
+        elif closing == ')' and text[i] == ']' and i + 1 < len(text) and text[i + 1] != '(':
+            # Квадратные скобки без ссылки
+            closing, i = None, i + 1
+        else:
+            i += 1
+
+        if closing is None:
+            safe_end = min(i, len(text))
+    return text[:safe_end]
+
+
+async def stream_answer(message, prompt: str, header: str, chat_id) -> str:
+    """Стримит ответ Gemini, не чаще раза в STREAM_EDIT_INTERVAL обновляя сообщение"""
+    loop = asyncio.get_running_loop()
+    answer = ''
+    shown = ''
+    last_edit = None
+    parse_mode = 'Markdown'
+
+    async for chunk in llm.stream(prompt, chat_id=chat_id):
+        answer += chunk
+        if last_edit is not None and loop.time() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+
+        partial = markdown_safe_prefix(answer) if parse_mode else answer
+        if not partial.strip() or partial == shown:
+            continue
+
+        text = (header + partial)[:TELEGRAM_MESSAGE_LIMIT - 2] + ' ▌'
+        try:
+            await message.edit_text(text, parse_mode=parse_mode)
+        except BadRequest as e:
+            # Модель может вернуть разметку, которую Telegram не принимает
+            report_error('stream_answer', e)
+            parse_mode = None
+        shown = partial
+        last_edit = loop.time()
+
+    return answer
+
+
+async def show_final_answer(message, text: str, keyboard) -> None:
+    """Показывает окончательный ответ; клавиатура появляется только вместе с ним"""
+    try:
+        await message.edit_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    except BadRequest:
+        await message.edit_text(text, reply_markup=keyboard)
+
+
 async def handle_university_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка вопросов о университете"""
 
@@ -97,60 +1851,91 @@ async def handle_university_question(update: Update, context: ContextTypes.DEFAU
     )
 
     question = update.message.text
-    selected_uni = context.user_data.get('selected_uni')
+    session_universities(context.user_data)
+    uni_id = context.user_data.get('selected_uni')
+    selected_uni = await university_store.load(uni_id) if uni_id else None
+    if selected_uni is None:
+        await loading_message.edit_text("❌ Информация не найдена. Начните поиск заново: /start")
+        return ConversationHandler.END
+    
+    header = f"*Ответ на ваш вопрос про {selected_uni['name']}:*\n\n"
+    footer = "\n\n_Задайте ещё вопрос или вернитесь к информации об университете_"
+    keyboard = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("↩️ Вернуться к информации", callback_data=f"back_{uni_id}"),
+            InlineKeyboardButton("❓ Задать ещё вопрос", callback_data=f"q_{uni_id}")
+        ]
+    ])
     
+    remember_question(context.user_data, uni_id, question)
+
+    session = qa_sessions.get(update.effective_user.id, uni_id, selected_uni) if QA_SESSIONS_ENABLED else None
+    # Ответ на уточняющий вопрос зависит от разговора, поэтому кэш - только для первого вопроса
+    first_question = session is None or not (session.turns or session.summary)
+
+    cached_answer = None
+    shared_key = AnswerCache.shared_key(uni_id, question) if shared_store.readable else ''
+    if first_question:
+        cached_answer = answer_cache.get(uni_id, question)
+        if cached_answer is None and shared_key:
+            # Похожие формулировки ищутся только в памяти, в общем хранилище - точное совпадение
+            cached_answer = await shared_store.get('answers', shared_key)
+            if cached_answer is not None:
+                answer_cache.set(uni_id, question, cached_answer)
+    if cached_answer is not None:
+        if session is not None:
+            qa_sessions.record(session, question, cached_answer)
+        await show_final_answer(loading_message, header + cached_answer + footer, keyboard)
+        return SHOWING_UNIVERSITIES
 
     await loading_message.edit_text(
         "🔄 *Генерирую подробный ответ...*",
         parse_mode='Markdown'
     )
     
-    prompt = f"""
-    Вопрос про университет {selected_uni['name']}:
-    {question}
+    if session is not None:
+        prompt = session.build_prompt(question)
+    else:
+        prompt = f"""
+        Вопрос про университет {selected_uni['name']}:
+        {question}
 
-    Контекст об университете:
-    {json.dumps(selected_uni, ensure_ascii=False)}
+        Контекст об университете:
+        {json.dumps(thaw(selected_uni), ensure_ascii=False)}
 
-    Дай максимально подробный и полезный ответ на вопрос студента, 
-    включая конкретные факты, цифры и рекомендации где это уместно.
-    """
+        Дай максимально подробный и полезный ответ на вопрос студента, 
+        включая конкретные факты, цифры и рекомендации где это уместно.
+        """
     
     try:
-        response = model.generate_content(prompt)
-        
-
-        await loading_message.delete()
+        if QA_STREAMING_ENABLED:
+            answer = await stream_answer(loading_message, prompt, header, update.message.chat_id)
+        else:
+            answer = await llm.generate(prompt, chat_id=update.message.chat_id)
         
 
-        response_text = (
-            f"*Ответ на ваш вопрос про {selected_uni['name']}:*\n\n"
-            f"{response.text}\n\n"
-            f"_Задайте ещё вопрос или вернитесь к информации об университете_"
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("↩️ Вернуться к информации", callback_data="back"),
-                InlineKeyboardButton("❓ Задать ещё вопрос", callback_data=f"q_{selected_uni['name']}")
-            ]
-        ]
-        
-        await update.message.reply_text(
-            response_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        answer = answer[:TELEGRAM_MESSAGE_LIMIT - len(header) - len(footer)]
+        if first_question:
+            answer_cache.set(uni_id, question, answer)
+            if shared_key:
+                await shared_store.set('answers', shared_key, answer, ttl=ANSWER_CACHE_TTL)
+        if session is not None:
+            qa_sessions.record(session, question, answer)
+        await show_final_answer(loading_message, header + answer + footer, keyboard)
         return SHOWING_UNIVERSITIES
         
+    except GenerationCancelled:
+        await loading_message.delete()
+        return ConversationHandler.END
+
     except Exception as e:
 
         await loading_message.delete()
-        print(f"Error: {str(e)}")
+        report_error('handle_university_question', e)
         
         error_keyboard = [
             [
-                InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"q_{selected_uni['name']}"),
+                InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"q_{uni_id}"),
                 InlineKeyboardButton("↩️ Вернуться назад", callback_data="back")
             ]
         ]
@@ -162,23 +1947,11 @@ async def handle_university_question(update: Update, context: ContextTypes.DEFAU
             parse_mode='Markdown'
         )
         return SHOWING_UNIVERSITIES
-async def process_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка информации о студенте и подбор университетов"""
-    
-    loading_message = await update.message.reply_text(
-        "*🔄 Анализируем ваши данные и подбираем университеты...*",
-        parse_mode='Markdown'
-    )
-    
-    await context.bot.send_chat_action(
-        chat_id=update.message.chat_id,
-        action="typing"
-    )
-    
-    user_info = context.user_data
+def build_recommendation_prompt(user_info) -> str:
+    """Формирует запрос к Gemini для подбора университетов"""
     location_prompt = f"в городе {user_info.get('country', 'Не указано')}" if user_info.get('country') else ""
     
-    prompt = f"""
+    return f"""
     На основе данных студента создай JSON строго в следующем формате с информацией о трех подходящих университетах {location_prompt}.
     Важно: выбирай только реально существующие университеты в указанном городе/стране.
 
@@ -232,74 +2005,555 @@ async def process_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     Верни только JSON без дополнительного текста.
     """
-    
+
+
+def parse_score(value):
+    """Извлекает число из ответа пользователя ("GPA 3,7" -> 3.7), None - если числа нет"""
+    match = re.search(r'\d+(?:[.,]\d+)?', str(value or ''))
+    return float(match.group(0).replace(',', '.')) if match else None
+
+
+def parse_amount(value):
+    """Извлекает сумму из строки вида "10 000" или "12,500 USD", None - если числа нет"""
+    return parse_score(re.sub(r'(?<=\d)[\s,](?=\d{3}\b)', '', str(value or '')))
+
+
+def score_bucket(value, step: float, low: float, high: float, parse=parse_score):
+    """Округляет балл вниз до границы диапазона шириной step.
+
+    Значение вне [low, high] - скорее опечатка или другая шкала, поэтому оно не округляется:
+    такой профиль совпадает только с точно таким же вводом.
+    """
+    score = parse(value)
+    if score is None:
+        return None
+    if not low <= score <= high:
+        return ' '.join(str(value).casefold().split())
+    return round(math.floor(score / step) * step, 2)
+
+
+def recommendation_cache_key(user_info) -> tuple:
+    """Ключ кэша рекомендаций по нормализованному профилю студента"""
+    additional_info = ' '.join(str(user_info.get('additional_info') or '').casefold().split())
+    return (
+        score_bucket(user_info.get('gpa'), RECOMMENDATION_GPA_STEP, 0, 5),
+        normalize_university_name(str(user_info.get('country') or '')),
+        score_bucket(user_info.get('sat'), RECOMMENDATION_SAT_STEP, 400, 1600, parse=parse_amount),
+        score_bucket(user_info.get('ielts'), RECOMMENDATION_IELTS_STEP, 0, 9),
+        hashlib.sha1(additional_info.encode()).hexdigest()[:16] if additional_info else ''
+    )
+
+
+recommendation_cache = LRUCache(RECOMMENDATION_CACHE_SIZE, ttl=RECOMMENDATION_CACHE_TTL)
+
+
+class UniversityCatalog:
+    """Локальный каталог университетов в SQLite с полнотекстовым поиском и числовыми индексами"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog')
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS universities (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    country TEXT,
+                    city TEXT,
+                    location TEXT,
+                    gpa_min REAL,
+                    sat_min REAL,
+                    ielts_min REAL,
+                    tuition REAL,
+                    currency TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS universities_country ON universities (country);
+                CREATE INDEX IF NOT EXISTS universities_city ON universities (city);
+                CREATE INDEX IF NOT EXISTS universities_location ON universities (location);
+                CREATE INDEX IF NOT EXISTS universities_gpa ON universities (gpa_min);
+                CREATE INDEX IF NOT EXISTS universities_sat ON universities (sat_min);
+                CREATE INDEX IF NOT EXISTS universities_ielts ON universities (ielts_min);
+                CREATE INDEX IF NOT EXISTS universities_tuition ON universities (tuition);
+                CREATE VIRTUAL TABLE IF NOT EXISTS universities_fts USING fts5 (
+                    id UNINDEXED, name, location, description, programs
+                );
+                -- Все запросы, по которым университет находился: один вуз подходит под разные страны и города
+                CREATE TABLE IF NOT EXISTS university_locations (
+                    uni_id TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    PRIMARY KEY (uni_id, location)
+                );
+                CREATE INDEX IF NOT EXISTS university_locations_location ON university_locations (location);
+                INSERT OR IGNORE INTO university_locations (uni_id, location)
+                    SELECT id, location FROM universities WHERE location IS NOT NULL;
+            """)
+        return self._connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _upsert(self, universities: list, country: str = None, city: str = None, location: str = None) -> int:
+        connection = self._connect()
+        count = 0
+        with connection:
+            for uni in universities:
+                if not isinstance(uni, dict) or not uni.get('name'):
+                    continue
+                uni_id = generate_uni_id(uni['name'])
+                requirements = uni.get('requirements') or {}
+                tuition = uni.get('tuition') or {}
+                uni_country = normalize_university_name(uni.get('country') or country or '') or None
+                uni_city = normalize_university_name(uni.get('city') or city or '') or None
+                uni_location = normalize_university_name(location or '') or None
+                if uni_location is None:
+                    # При импорте запись ищется и по стране, и по городу
+                    uni_location = uni_city or uni_country
+                programs = uni.get('programs') or []
+
+                connection.execute(
+                    'INSERT OR REPLACE INTO universities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        uni_id, uni['name'], uni_country, uni_city, uni_location,
+                        parse_score(requirements.get('gpa')),
+                        parse_amount(requirements.get('sat')),
+                        parse_score(requirements.get('ielts')),
+                        parse_amount(tuition.get('amount')),
+                        tuition.get('currency'),
+                        json.dumps(uni, ensure_ascii=False),
+                        time.time()
+                    )
+                )
+                if uni_location is not None:
+                    connection.execute(
+                        'INSERT OR IGNORE INTO university_locations (uni_id, location) VALUES (?, ?)',
+                        (uni_id, uni_location)
+                    )
+                locations = [row[0] for row in connection.execute(
+                    'SELECT location FROM university_locations WHERE uni_id = ?', (uni_id,)
+                )]
+                connection.execute('DELETE FROM universities_fts WHERE id = ?', (uni_id,))
+                connection.execute(
+                    'INSERT INTO universities_fts VALUES (?, ?, ?, ?, ?)',
+                    (
+                        uni_id, uni['name'],
+                        ' '.join(dict.fromkeys(filter(None, (uni_country, uni_city, *locations)))),
+                        uni.get('description') or '',
+                        ' '.join(map(str, programs)) if isinstance(programs, list) else str(programs)
+                    )
+                )
+                count += 1
+        return count
+
+    def _search(self, user_info, limit: int) -> list:
+        location = normalize_university_name(str(user_info.get('country') or ''))
+        gpa = parse_score(user_info.get('gpa'))
+        sat = parse_amount(user_info.get('sat'))
+        ielts = parse_score(user_info.get('ielts'))
+
+        conditions = []
+        params = []
+        if location:
+            conditions.append(
+                '(u.country = ? OR u.city = ? OR u.id IN (SELECT uni_id FROM university_locations WHERE location = ?))'
+            )
+            params += [location, location, location]
+        for column, value in (('gpa_min', gpa), ('sat_min', sat), ('ielts_min', ielts)):
+            if value is not None:
+                conditions.append(f'(u.{column} IS NULL OR u.{column} <= ?)')
+                params.append(value)
+        where = ' AND '.join(conditions) or '1'
+
+        # Самые сильные университеты, куда студент проходит, - первыми
+        order = 'u.gpa_min IS NULL, u.gpa_min DESC, u.tuition IS NULL, u.tuition'
+        words = normalize_question(str(user_info.get('additional_info') or ''))
+        connection = self._connect()
+        rows = []
+        if words:
+            # Сначала - совпадения с пожеланиями студента, затем остальные подходящие
+            match = ' OR '.join(f'"{word}"*' for word in words)
+            rows = connection.execute(
+                f'SELECT u.id, u.data FROM universities u JOIN universities_fts f ON f.id = u.id '
+                f'WHERE universities_fts MATCH ? AND {where} ORDER BY bm25(universities_fts), {order} LIMIT ?',
+                [match] + params + [limit]
+            ).fetchall()
+        if len(rows) < limit:
+            found = {row[0] for row in rows}
+            rows += [
+                row for row in connection.execute(
+                    f'SELECT u.id, u.data FROM universities u WHERE {where} ORDER BY {order} LIMIT ?',
+                    params + [limit]
+                ).fetchall()
+                if row[0] not in found
+            ][:limit - len(rows)]
+        return [json.loads(data) for _, data in rows]
+
+    def _get(self, uni_id: str):
+        row = self._connect().execute('SELECT data FROM universities WHERE id = ?', (uni_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get(self, uni_id: str):
+        """Университет по идентификатору или None, если его нет в каталоге"""
+        return await self._run(self._get, uni_id)
+
+    async def add(self, universities: list, location: str = None) -> int:
+        """Добавляет университеты из ответа модели, запомнив, по какому запросу они найдены"""
+        return await self._run(self._upsert, universities, None, None, location)
+
+    async def search(self, user_info, limit: int) -> list:
+        """Отбирает университеты, подходящие профилю студента"""
+        return await self._run(self._search, user_info, limit)
+
+    def import_file(self, path: str) -> int:
+        """Импортирует университеты из JSON (как в ответе модели) или CSV"""
+        if path.lower().endswith('.csv'):
+            with open(path, encoding='utf-8', newline='') as f:
+                universities = [university_from_csv_row(row) for row in csv.DictReader(f)]
+        else:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            universities = data.get('universities', []) if isinstance(data, dict) else data
+        return self._upsert(universities)
+
+
+def university_from_csv_row(row: dict) -> dict:
+    """Собирает запись университета в формате ответа модели из строки CSV"""
+    def split(value):
+        return [item.strip() for item in (value or '').split(';') if item.strip()]
+
+    return {
+        'name': row.get('name'),
+        'country': row.get('country'),
+        'city': row.get('city'),
+        'description': row.get('description', ''),
+        'requirements': {
+            'gpa': row.get('gpa', ''),
+            'sat': row.get('sat', ''),
+            'ielts': row.get('ielts', ''),
+            'documents': row.get('documents', ''),
+            'additional': row.get('additional', '')
+        },
+        'deadlines': {
+            'early': row.get('deadline_early', ''),
+            'regular': row.get('deadline_regular', ''),
+            'rolling': row.get('rolling', '')
+        },
+        'tuition': {
+            'amount': row.get('tuition', ''),
+            'currency': row.get('currency', 'USD')
+        },
+        'programs': split(row.get('programs')),
+        'scholarships': {
+            'types': split(row.get('scholarship_types')),
+            'amounts': split(row.get('scholarship_amounts')),
+            'requirements': row.get('scholarship_requirements', '')
+        }
+    }
+
+
+catalog = UniversityCatalog(CATALOG_PATH)
+
+
+async def rerank_candidates(user_info, candidates: list, chat_id=None) -> list:
+    """Просит модель выбрать лучшие университеты из найденных в каталоге"""
+    names = "\n".join(f"{i}. {uni['name']}" for i, uni in enumerate(candidates))
+    prompt = f"""
+    Выбери {RECOMMENDATIONS_COUNT} университета из списка, которые лучше всего подходят студенту.
+
+    Университеты:
+    {names}
+
+    Данные студента:
+    GPA: {user_info.get('gpa', 'Не указано')}
+    Страна/Город: {user_info.get('country', 'Не указано')}
+    SAT: {user_info.get('sat', 'Не указано')}
+    IELTS: {user_info.get('ielts', 'Не указано')}
+    Дополнительная информация: {user_info.get('additional_info', 'Не указано')}
+
+    Верни только JSON вида {{"order": [номера университетов по убыванию соответствия]}}.
+    """
+    response_text = await llm.generate(prompt, chat_id=chat_id)
+    order = json.loads(clean_json_string(response_text)).get('order', [])
+    ranked = [candidates[i] for i in dict.fromkeys(order) if isinstance(i, int) and 0 <= i < len(candidates)]
+    ranked += [uni for uni in candidates if uni not in ranked]
+    return ranked[:RECOMMENDATIONS_COUNT]
+
+
+async def get_catalog_recommendations(user_info, chat_id=None):
+    """Подбирает университеты по каталогу; None - если подходящих записей слишком мало"""
+    candidates = await catalog.search(user_info, CATALOG_CANDIDATES)
+    if len(candidates) < RECOMMENDATIONS_COUNT:
+        return None
+    if not CATALOG_RERANK or len(candidates) == RECOMMENDATIONS_COUNT:
+        return candidates[:RECOMMENDATIONS_COUNT]
     try:
+        return await rerank_candidates(user_info, candidates, chat_id=chat_id)
+    except CircuitOpen:
+        return candidates[:RECOMMENDATIONS_COUNT]
+    except (ValueError, AttributeError, asyncio.TimeoutError) + GEMINI_TRANSIENT_ERRORS as e:
+        report_error('rerank_candidates', e)
+        return candidates[:RECOMMENDATIONS_COUNT]
 
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
-        
 
-        json_str = clean_json_string(response_text)
-        data = json.loads(json_str)
-        universities = data.get('universities', [])
+async def iter_recommendations(user_info, chat_id=None, stream: bool = RECOMMENDATION_STREAMING_ENABLED,
+                               use_cache: bool = True):
+    """Подбирает университеты (из кэша, по каталогу или через Gemini) и отдает их по одному.
+
+    В потоковом режиме каждый университет отдается, как только модель допишет его объект.
+    use_cache=False - не читать кэш, а подобрать заново и обновить его.
+    """
+    cache_key = recommendation_cache_key(user_info)
+    if RECOMMENDATION_CACHE_ENABLED and use_cache:
+        cached = recommendation_cache.get(cache_key)
+        if cached is None and shared_store.readable:
+            cached = await shared_store.get('recommendations', json.dumps(cache_key))
+            if cached is not None:
+                recommendation_cache.set(cache_key, cached)
+        if cached is not None:
+            for uni in cached:
+                yield uni
+            return
+
+    universities = None
+    # Пока предохранитель Gemini разомкнут, подбираем по каталогу и в режиме llm
+    if CATALOG_ENABLED and (RECOMMENDATION_SOURCE == 'catalog' or llm.breaker.is_open()):
+        universities = await get_catalog_recommendations(user_info, chat_id=chat_id)
+        for uni in universities or ():
+            yield uni
+
+    if universities is None:
+        prompt = build_recommendation_prompt(user_info)
+        universities = []
+        if stream:
+            parser = UniversityStreamParser()
+            async for chunk in llm.stream(prompt, chat_id=chat_id):
+                for uni in parser.feed(chunk):
+                    universities.append(uni)
+                    yield uni
+            remaining = parser.finish()
+        else:
+            response_text = (await llm.generate(prompt, chat_id=chat_id)).strip()
+            json_str = clean_json_string(response_text)
+            remaining = json.loads(json_str).get('universities', [])
+
+        for uni in remaining:
+            universities.append(uni)
+            yield uni
         
         if not universities:
             raise ValueError("No universities found in response")
-        
-        await loading_message.delete()
-        
 
-        await update.message.reply_text(
-            "🎯 *Найдены подходящие университеты!*\n"
-            "_Нажмите на кнопки под каждым университетом для подробной информации_",
+        if CATALOG_ENABLED:
+            try:
+                await catalog.add(universities, location=user_info.get('country'))
+            except sqlite3.Error as e:
+                report_error('catalog', e)
+
+    if RECOMMENDATION_CACHE_ENABLED:
+        recommendation_cache.set(cache_key, universities)
+        await shared_store.set('recommendations', json.dumps(cache_key), universities, ttl=RECOMMENDATION_CACHE_TTL)
+
+
+async def get_recommendations(user_info, chat_id=None, use_cache: bool = True) -> list:
+    """Подбирает университеты для профиля студента целиком"""
+    return [
+        uni async for uni in iter_recommendations(user_info, chat_id=chat_id, stream=False, use_cache=use_cache)
+    ]
+
+
+async def iterate_list(items):
+    for item in items:
+        yield item
+
+
+TRIVIAL_ADDITIONAL_INFO = frozenset({
+    '', '-', '/skip', 'нет', 'ничего', 'не знаю', 'пропустить', 'no', 'none', 'nothing', 'n/a', 'skip'
+})
+
+
+def recommendation_profile(user_info) -> dict:
+    """Данные анкеты, от которых зависит подбор; пустая дополнительная информация отбрасывается"""
+    profile = {
+        key: user_info[key] for key in ('gpa', 'country', 'sat', 'ielts', 'additional_info')
+        if user_info.get(key)
+    }
+    additional_info = ' '.join(str(profile.get('additional_info', '')).casefold().split()).strip('.!')
+    if additional_info in TRIVIAL_ADDITIONAL_INFO:
+        profile.pop('additional_info', None)
+    return profile
+
+
+class Speculator:
+    """Подбор университетов заранее, пока пользователь отвечает на последний вопрос анкеты.
+
+    Задача запускается, как только известны GPA, страна, SAT и IELTS. Если дополнительная
+    информация в итоге пустая, process_info забирает готовый результат; иначе задача
+    отменяется. Одновременно выполняется не больше max_jobs задач, чтобы спекулятивные
+    запросы не занимали все слоты Gemini.
+    """
+
+    def __init__(self, max_jobs: int, ttl: float):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.stats = Counter()
+        self._jobs = {}
+
+    def running(self) -> int:
+        return sum(1 for _, task, _ in self._jobs.values() if not task.done())
+
+    def _prune(self) -> None:
+        # Готовые результаты тех, кто так и не дошел до конца анкеты
+        deadline = time.monotonic() - self.ttl
+        for chat_id, (_, task, started) in list(self._jobs.items()):
+            if task.done() and started < deadline:
+                del self._jobs[chat_id]
+                self.stats['expired'] += 1
+
+    def start(self, chat_id, user_info) -> bool:
+        """Запускает фоновый подбор для профиля без дополнительной информации"""
+        self.cancel(chat_id)
+        self._prune()
+        if self.running() >= self.max_jobs:
+            self.stats['rejected'] += 1
+            return False
+
+        profile = recommendation_profile(user_info)
+        profile.pop('additional_info', None)
+        task = asyncio.ensure_future(self._run(profile, chat_id))
+        task.add_done_callback(self._done)
+        self._jobs[chat_id] = (recommendation_cache_key(profile), task, time.monotonic())
+        self.stats['started'] += 1
+        return True
+
+    def _done(self, task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.stats['failed'] += 1
+
+    async def _run(self, profile: dict, chat_id) -> list:
+        # Задача переживает обработчик, который ее запустил, поэтому срок у нее свой
+        with deadline(HANDLER_DEADLINE, fresh=True):
+            universities = await get_recommendations(profile, chat_id=chat_id)
+        # Изображения качаются в фоне и попадут в кэш к моменту отправки карточек
+        for uni in universities:
+            prefetch_university_image(uni.get('name', ''))
+        return universities
+
+    def cancel(self, chat_id) -> None:
+        job = self._jobs.pop(chat_id, None)
+        if job is not None and not job[1].done():
+            job[1].cancel()
+            self.stats['cancelled'] += 1
+
+    def ready(self, chat_id, profile: dict) -> bool:
+        """Готов ли подходящий профилю результат - тогда сообщение о загрузке не нужно"""
+        job = self._jobs.get(chat_id)
+        if job is None or recommendation_cache_key(profile) != job[0]:
+            return False
+        task = job[1]
+        return task.done() and not task.cancelled() and task.exception() is None
+
+    async def claim(self, chat_id, profile: dict):
+        """Возвращает результат задачи, если он подходит профилю, иначе отменяет ее и возвращает None"""
+        job = self._jobs.pop(chat_id, None)
+        if job is None:
+            return None
+        cache_key, task, _ = job
+        if recommendation_cache_key(profile) != cache_key:
+            if not task.done():
+                task.cancel()
+            self.stats['discarded'] += 1
+            return None
+        try:
+            # shield отделяет отмену самого обработчика от отмены задачи (llm.cancel, прогон по TTL)
+            universities = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # Отменен обработчик: результат больше никому не нужен, а отмена идет дальше
+                task.cancel()
+                raise
+            return None
+        except Exception:
+            return None
+        self.stats['used'] += 1
+        return universities
+
+
+speculator = Speculator(SPECULATION_MAX_JOBS, SPECULATION_TTL)
+
+
+async def process_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка информации о студенте и подбор университетов"""
+    
+    profile = recommendation_profile(context.user_data)
+    loading_message = None
+    if not speculator.ready(update.message.chat_id, profile):
+        loading_message = await update.message.reply_text(
+            "*🔄 Анализируем ваши данные и подбираем университеты...*",
             parse_mode='Markdown'
         )
         
-        user_universities = {}
-        
-        for uni in universities:
-            try:
-                uni_id = generate_uni_id(uni['name'])
-                user_universities[uni_id] = uni
-                
-                programs_text = "\n".join([f"• {prog}" for prog in uni.get('programs', [])])
-                
-
-                main_info = (
-                    f"🏛 *{uni['name']}*\n\n"
-                    f"📝 *Описание:*\n{uni['description']}\n\n"
-                    f"🎓 *Доступные программы:*\n{programs_text}\n\n"
-                    f"💰 *Стоимость обучения:*\n"
-                    f"{uni['tuition']['amount']} {uni['tuition']['currency']}/год"
-                )
-                
+        await context.bot.send_chat_action(
+            chat_id=update.message.chat_id,
+            action="typing"
+        )
+    
+    user_universities = []
+    card_task = None
 
-                keyboard = [
-                    [
-                        InlineKeyboardButton("📋 Требования", callback_data=f"r_{uni_id}"),
-                        InlineKeyboardButton("💰 Стипендии", callback_data=f"s_{uni_id}")
-                    ],
-                    [
-                        InlineKeyboardButton("❓ Задать вопрос", callback_data=f"q_{uni_id}"),
-                        InlineKeyboardButton("📚 Подробнее", callback_data=f"u_{uni_id}")
-                    ]
-                ]
-                
-                img_data = await get_university_image(uni['name'])
-                await context.bot.send_photo(
-                    chat_id=update.message.chat_id,
-                    photo=img_data,
-                    caption=main_info,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+    async def send_card(uni, image_task, previous):
+        # Карточки уходят строго по порядку, но каждая начинает готовиться сразу
+        if previous is not None:
+            await previous
+        try:
+            uni_id = university_store.add(uni)
+            main_info, keyboard = build_university_card(uni_id, university_store.get(uni_id))
+            
+            message = await send_university_photo(
+                context.bot,
+                update.message.chat_id,
+                uni['name'],
+                image_task=image_task,
+                caption=main_info,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
+            if uni_id not in user_universities:
+                user_universities.append(uni_id)
+            context.user_data.setdefault('card_messages', {})[uni_id] = message.message_id
+            
+        except Exception as e:
+            report_error('process_info', e, uni.get('name'))
+
+    try:
+        # Университеты приходят по одному по мере генерации: для каждого сразу начинается
+        # загрузка изображения, а карточка отправляется, как только дойдет ее очередь
+        universities = await speculator.claim(update.message.chat_id, profile)
+        if universities is None:
+            universities = iter_recommendations(profile, chat_id=update.message.chat_id)
+        else:
+            universities = iterate_list(universities)
+
+        async for uni in universities:
+            if card_task is None:
+                if loading_message is not None:
+                    await loading_message.delete()
+                await update.message.reply_text(
+                    "🎯 *Найдены подходящие университеты!*\n"
+                    "_Нажмите на кнопки под каждым университетом для подробной информации_",
                     parse_mode='Markdown'
                 )
-                
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                print(f"Error processing university {uni['name']}: {str(e)}")
-                continue
-        
+            image_task = prefetch_university_image(uni.get('name', ''))
+            card_task = asyncio.ensure_future(send_card(uni, image_task, card_task))
+
+        await card_task
         context.user_data['universities'] = user_universities
         
         final_keyboard = [
@@ -314,9 +2568,25 @@ async def process_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         return SHOWING_UNIVERSITIES
         
+    except GenerationCancelled:
+        if card_task is None:
+            if loading_message is not None:
+                await loading_message.delete()
+        else:
+            card_task.cancel()
+        return ConversationHandler.END
+
     except Exception as e:
-        print(f"Error in process_info: {str(e)}")
-        await loading_message.delete()
+        report_error('process_info', e)
+        if card_task is None:
+            if loading_message is not None:
+                await loading_message.delete()
+        else:
+            await card_task
+            if user_universities:
+                # Часть карточек уже показана - оставляем их вместо сообщения об ошибке
+                context.user_data['universities'] = user_universities
+                return SHOWING_UNIVERSITIES
         await update.message.reply_text(
             "❌ Произошла ошибка. Попробуйте еще раз с командой /start",
             parse_mode='Markdown'
@@ -329,8 +2599,7 @@ async def handle_scholarship_info(update: Update, context: ContextTypes.DEFAULT_
     
     try:
         uni_id = query.data.split('_')[1]
-        universities = context.user_data.get('universities', {})
-        selected_uni = universities.get(uni_id)
+        selected_uni = await session_university(context.user_data, uni_id)
         
         if selected_uni:
             scholarships_text = (
@@ -357,7 +2626,7 @@ async def handle_scholarship_info(update: Update, context: ContextTypes.DEFAULT_
         return SHOWING_UNIVERSITIES
         
     except Exception as e:
-        print(f"Error in handle_scholarship_info: {str(e)}")
+        report_error('handle_scholarship_info', e)
         await query.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
         return SHOWING_UNIVERSITIES
 
@@ -377,15 +2646,14 @@ async def handle_university_selection(update: Update, context: ContextTypes.DEFA
             return SHOWING_UNIVERSITIES
             
         action, uni_id = query.data.split('_')
-        universities = context.user_data.get('universities', {})
-        selected_uni = universities.get(uni_id)
+        selected_uni = await session_university(context.user_data, uni_id)
         
         if not selected_uni:
             await query.message.reply_text("❌ Информация не найдена")
             return SHOWING_UNIVERSITIES
 
         if action == 'q': 
-            context.user_data['selected_uni'] = selected_uni
+            context.user_data['selected_uni'] = uni_id
             await query.message.reply_text(
                 f"❓ *Задайте ваш вопрос про {selected_uni['name']}*\n\n"
                 "Я постараюсь предоставить подробную информацию по интересующей вас теме.",
@@ -393,67 +2661,18 @@ async def handle_university_selection(update: Update, context: ContextTypes.DEFA
             )
             return UNIVERSITY_QUESTIONS
         
-        keyboard = [[InlineKeyboardButton("↩️ Назад", callback_data="back")]]
-        
-        if action == 'r':  
-            requirements = selected_uni['requirements']
-            deadlines = selected_uni['deadlines']
-            info_text = (
-                f"📋 *Требования для поступления в {selected_uni['name']}*\n\n"
-                f"📊 *GPA:* {requirements['gpa']}\n"
-                f"📝 *SAT:* {requirements['sat']}\n"
-                f"🌐 *IELTS:* {requirements['ielts']}\n\n"
-                f"📎 *Необходимые документы:*\n{requirements['documents']}\n\n"
-                f"ℹ️ *Дополнительно:*\n{requirements['additional']}\n\n"
-                f"📅 *Сроки подачи:*\n"
-                f"• Ранняя подача: {deadlines['early']}\n"
-                f"• Обычная подача: {deadlines['regular']}\n"
-                f"• Rolling admission: {deadlines['rolling']}"
-            )
-            
-            await query.message.reply_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            
-        elif action == 's':  
-            scholarships = selected_uni['scholarships']
-            info_text = (
-                f"💰 *Стипендии в {selected_uni['name']}*\n\n"
-                f"📋 *Доступные виды стипендий:*\n"
-                + "\n".join([f"• {s}" for s in scholarships['types']]) + "\n\n"
-                f"💵 *Размеры стипендий:*\n"
-                + "\n".join([f"• {a}" for a in scholarships['amounts']]) + "\n\n"
-                f"✅ *Требования для получения:*\n{scholarships['requirements']}"
-            )
-            
-            await query.message.reply_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            
-        elif action == 'u':  
-            programs_text = "\n".join([f"• {prog}" for prog in selected_uni['programs']])
-            info_text = (
-                f"🏛 *{selected_uni['name']}*\n\n"
-                f"📝 *Описание:*\n{selected_uni['description']}\n\n"
-                f"🎓 *Программы обучения:*\n{programs_text}\n\n"
-                f"💰 *Стоимость обучения:*\n"
-                f"{selected_uni['tuition']['amount']} {selected_uni['tuition']['currency']}/год"
-            )
-            
-            await query.message.reply_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
+        if action not in UNIVERSITY_VIEWS or action == 'card':
+            return SHOWING_UNIVERSITIES
+
+        # Подробности показываются на месте карточки, «Назад» возвращает ее обратно
+        info_text = university_store.view(uni_id, selected_uni, action)
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Назад", callback_data=f"back_{uni_id}")]])
+        await show_in_place(query.message, info_text, keyboard)
         
         return UNIVERSITY_INFO
         
     except Exception as e:
-        print(f"Error in handle_university_selection: {str(e)}")
+        report_error('handle_university_selection', e)
         await query.message.reply_text(
             "❌ Произошла ошибка. Попробуйте еще раз с командой /start",
             reply_markup=InlineKeyboardMarkup([[
@@ -467,12 +2686,14 @@ async def handle_question_history(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     
-    selected_uni = context.user_data.get('selected_uni')
+    session_universities(context.user_data)
+    uni_id = context.user_data.get('selected_uni')
+    selected_uni = await university_store.load(uni_id) if uni_id else None
     if not selected_uni:
         await query.message.reply_text("❌ Информация не найдена")
         return SHOWING_UNIVERSITIES
         
-    history = context.user_data.get('question_history', {}).get(selected_uni['name'], [])
+    history = context.user_data.get('question_history', {}).get(uni_id, [])
     
     if not history:
         await query.message.reply_text(
@@ -489,7 +2710,7 @@ async def handle_question_history(update: Update, context: ContextTypes.DEFAULT_
         history_text += f"{i}. {question}\n"
     
     keyboard = [
-        [InlineKeyboardButton("❓ Задать новый вопрос", callback_data=f"q_{selected_uni['name']}")],
+        [InlineKeyboardButton("❓ Задать новый вопрос", callback_data=f"q_{uni_id}")],
         [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
         [InlineKeyboardButton("↩️ Назад", callback_data="back")]
     ]
@@ -506,9 +2727,11 @@ async def clear_question_history(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    selected_uni = context.user_data.get('selected_uni')
-    if selected_uni and selected_uni['name'] in context.user_data.get('question_history', {}):
-        context.user_data['question_history'][selected_uni['name']] = []
+    session_universities(context.user_data)
+    uni_id = context.user_data.get('selected_uni')
+    if uni_id:
+        context.user_data.get('question_history', {}).pop(uni_id, None)
+        qa_sessions.drop(update.effective_user.id, uni_id)
     
     await query.message.reply_text(
         "🗑️ История вопросов очищена",
@@ -519,6 +2742,7 @@ async def clear_question_history(update: Update, context: ContextTypes.DEFAULT_T
     return SHOWING_UNIVERSITIES
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало разговора и запрос GPA"""
+    speculator.cancel(update.message.chat_id)
     context.user_data.clear()  
     context.user_data['state'] = GPA  
     await update.message.reply_text(
@@ -542,6 +2766,8 @@ async def skip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if current_state in next_states:
         next_state, message = next_states[current_state]
         context.user_data['state'] = next_state
+        if next_state == ADDITIONAL_INFO and SPECULATION_ENABLED:
+            speculator.start(update.message.chat_id, context.user_data)
         await update.message.reply_text(message)
         return next_state
     
@@ -576,6 +2802,8 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     if current_state in next_states:
         next_state, message = next_states[current_state]
         context.user_data['state'] = next_state
+        if next_state == ADDITIONAL_INFO and SPECULATION_ENABLED:
+            speculator.start(update.message.chat_id, context.user_data)
         await update.message.reply_text(message)
         return next_state
     
@@ -586,59 +2814,268 @@ def generate_uni_id(uni_name: str) -> str:
     return hashlib.md5(uni_name.encode()).hexdigest()[:8]
 
 
+def render_university_card(uni: dict) -> str:
+    """Подпись карточки университета; описание укорачивается, чтобы подпись влезла в лимит Telegram"""
+    programs_text = "\n".join([f"• {prog}" for prog in uni.get('programs', [])])
+    
+    def caption(description):
+        return (
+            f"🏛 *{uni['name']}*\n\n"
+            f"📝 *Описание:*\n{description}\n\n"
+            f"🎓 *Доступные программы:*\n{programs_text}\n\n"
+            f"💰 *Стоимость обучения:*\n"
+            f"{uni['tuition']['amount']} {uni['tuition']['currency']}/год"
+        )
+
+    text = caption(uni['description'])
+    overflow = len(text) - TELEGRAM_CAPTION_LIMIT
+    if overflow > 0:
+        description = uni['description']
+        text = caption(description[:max(len(description) - overflow - 1, 0)].rstrip() + '…')
+    if len(text) > TELEGRAM_CAPTION_LIMIT:
+        text = markdown_safe_prefix(text[:TELEGRAM_CAPTION_LIMIT - 1]) + '…'
+    return text
+
+
+def render_requirements(uni: dict) -> str:
+    requirements = uni['requirements']
+    deadlines = uni['deadlines']
+    return (
+        f"📋 *Требования для поступления в {uni['name']}*\n\n"
+        f"📊 *GPA:* {requirements['gpa']}\n"
+        f"📝 *SAT:* {requirements['sat']}\n"
+        f"🌐 *IELTS:* {requirements['ielts']}\n\n"
+        f"📎 *Необходимые документы:*\n{requirements['documents']}\n\n"
+        f"ℹ️ *Дополнительно:*\n{requirements['additional']}\n\n"
+        f"📅 *Сроки подачи:*\n"
+        f"• Ранняя подача: {deadlines['early']}\n"
+        f"• Обычная подача: {deadlines['regular']}\n"
+        f"• Rolling admission: {deadlines['rolling']}"
+    )
+
+
+def render_scholarships(uni: dict) -> str:
+    scholarships = uni['scholarships']
+    return (
+        f"💰 *Стипендии в {uni['name']}*\n\n"
+        f"📋 *Доступные виды стипендий:*\n"
+        + "\n".join([f"• {s}" for s in scholarships['types']]) + "\n\n"
+        f"💵 *Размеры стипендий:*\n"
+        + "\n".join([f"• {a}" for a in scholarships['amounts']]) + "\n\n"
+        f"✅ *Требования для получения:*\n{scholarships['requirements']}"
+    )
+
+
+def render_details(uni: dict) -> str:
+    programs_text = "\n".join([f"• {prog}" for prog in uni['programs']])
+    return (
+        f"🏛 *{uni['name']}*\n\n"
+        f"📝 *Описание:*\n{uni['description']}\n\n"
+        f"🎓 *Программы обучения:*\n{programs_text}\n\n"
+        f"💰 *Стоимость обучения:*\n"
+        f"{uni['tuition']['amount']} {uni['tuition']['currency']}/год"
+    )
+
+
+UNIVERSITY_VIEWS = {
+    'card': render_university_card,
+    'r': render_requirements,
+    's': render_scholarships,
+    'u': render_details
+}
+
+
+class UniversityStore:
+    """Общие для всех пользователей записи университетов по generate_uni_id.
+
+    Сессии хранят только идентификаторы: сотни популярных университетов держатся в памяти
+    по одному разу в виде FrozenRecord вместе с готовыми текстами представлений. Вытесненная
+    запись подгружается из каталога при следующем обращении.
+    """
+
+    def __init__(self, maxsize: int):
+        self.stats = Counter()
+        self._records = LRUCache(maxsize)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self, uni: Mapping) -> str:
+        """Запоминает университет и возвращает его идентификатор; уже известная запись не заменяется"""
+        uni_id = generate_uni_id(uni['name'])
+        if self._records.get(uni_id) is None:
+            self._records.set(uni_id, (freeze(uni), {}))
+            self.stats['added'] += 1
+        return uni_id
+
+    def get(self, uni_id: str):
+        entry = self._records.get(uni_id)
+        return entry[0] if entry is not None else None
+
+    async def load(self, uni_id: str):
+        """Запись из памяти или, если она вытеснена, из каталога; None - если университет неизвестен"""
+        record = self.get(uni_id)
+        if record is None and CATALOG_ENABLED:
+            try:
+                uni = await catalog.get(uni_id)
+            except sqlite3.Error as e:
+                report_error('university_store', e, uni_id)
+                uni = None
+            if uni is not None:
+                record = freeze(uni)
+                self._records.set(uni_id, (record, {}))
+                self.stats['loaded'] += 1
+        return record
+
+    def view(self, uni_id: str, uni: Mapping, view: str) -> str:
+        """Текст представления университета; каждое формируется один раз на процесс"""
+        entry = self._records.get(uni_id)
+        # Для вытесненной или посторонней записи текст просто формируется заново
+        views = entry[1] if entry is not None and entry[0] is uni else {}
+        text = views.get(view)
+        if text is None:
+            text = views[view] = university_digest(uni) if view == 'digest' else UNIVERSITY_VIEWS[view](uni)
+        return text
+
+
+university_store = UniversityStore(UNIVERSITY_STORE_SIZE)
+
+
+def session_universities(user_data: dict) -> list:
+    """Идентификаторы университетов из текущей подборки пользователя.
+
+    Сессии, сохраненные раньше, держали полные словари университетов - они переводятся
+    на идентификаторы при первом обращении.
+    """
+    universities = user_data.get('universities') or []
+    if isinstance(universities, dict):
+        universities = user_data['universities'] = [university_store.add(uni) for uni in universities.values()]
+        user_data.pop('views', None)
+    selected = user_data.get('selected_uni')
+    if isinstance(selected, Mapping):
+        user_data['selected_uni'] = university_store.add(selected)
+    return universities
+
+
+async def session_university(user_data: dict, uni_id: str):
+    """Запись университета из подборки пользователя или None, если его там нет"""
+    if not uni_id or uni_id not in session_universities(user_data):
+        return None
+    return await university_store.load(uni_id)
+
+
+def remember_question(user_data: dict, uni_id: str, question: str) -> None:
+    """Добавляет вопрос в историю: последние QA_HISTORY_LIMIT вопросов по QA_HISTORY_UNIVERSITIES университетам"""
+    history = user_data.setdefault('question_history', {})
+    questions = history.pop(uni_id, [])
+    history[uni_id] = questions
+    questions.append(question[:QA_HISTORY_QUESTION_CHARS])
+    del questions[:-QA_HISTORY_LIMIT]
+    while len(history) > QA_HISTORY_UNIVERSITIES:
+        history.pop(next(iter(history)))
+
+
+def university_card_keyboard(uni_id: str) -> InlineKeyboardMarkup:
+    keyboard = [
+        [
+            InlineKeyboardButton("📋 Требования", callback_data=f"r_{uni_id}"),
+            InlineKeyboardButton("💰 Стипендии", callback_data=f"s_{uni_id}")
+        ],
+        [
+            InlineKeyboardButton("❓ Задать вопрос", callback_data=f"q_{uni_id}"),
+            InlineKeyboardButton("📚 Подробнее", callback_data=f"u_{uni_id}")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def build_university_card(uni_id: str, uni: Mapping):
+    """Формирует подпись и клавиатуру карточки университета"""
+    return university_store.view(uni_id, uni, 'card'), university_card_keyboard(uni_id)
+
+
+async def show_in_place(message, text: str, keyboard) -> None:
+    """Меняет содержимое сообщения на месте одним запросом.
+
+    Подпись к фото ограничена 1024 символами, поэтому более длинный текст
+    приходится отправлять отдельным сообщением.
+    """
+    try:
+        if not message.photo:
+            await message.edit_text(text, reply_markup=keyboard, parse_mode='Markdown')
+        elif len(text) <= TELEGRAM_CAPTION_LIMIT:
+            await message.edit_caption(caption=text, reply_markup=keyboard, parse_mode='Markdown')
+        else:
+            await message.reply_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    except BadRequest as e:
+        # Повторное нажатие той же кнопки - сообщение уже в нужном виде
+        if 'not modified' not in str(e):
+            raise
+
+
 async def handle_back_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кнопки Назад"""
     query = update.callback_query
     await query.answer()
 
-    universities = context.user_data.get('universities', {})
+    universities = []
+    for uni_id in session_universities(context.user_data):
+        uni = await university_store.load(uni_id)
+        if uni is not None:
+            universities.append((uni_id, uni))
     if not universities:
         await query.message.reply_text(
             "❌ Информация о университетах не найдена. Начните поиск заново: /start"
         )
         return ConversationHandler.END
 
-    message_text = "🎯 *Выберите университет для получения информации:*\n\n"
+    chat_id = update.callback_query.message.chat_id
+    card_messages = context.user_data.setdefault('card_messages', {})
 
-    for uni_id, uni in universities.items():
-        programs_text = "\n".join([f"• {prog}" for prog in uni.get('programs', [])])
-        
-        uni_info = (
-            f"🏛 *{uni['name']}*\n\n"
-            f"📝 *Описание:*\n{uni['description']}\n\n"
-            f"🎓 *Доступные программы:*\n{programs_text}\n\n"
-            f"💰 *Стоимость обучения:*\n"
-            f"{uni['tuition']['amount']} {uni['tuition']['currency']}/год"
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📋 Требования", callback_data=f"r_{uni_id}"),
-                InlineKeyboardButton("💰 Стипендии", callback_data=f"s_{uni_id}")
-            ],
-            [
-                InlineKeyboardButton("❓ Задать вопрос", callback_data=f"q_{uni_id}"),
-                InlineKeyboardButton("📚 Подробнее", callback_data=f"u_{uni_id}")
-            ]
-        ]
+    uni_id = query.data[len('back_'):] if query.data.startswith('back_') else context.user_data.get('selected_uni')
+
+    uni = dict(universities).get(uni_id)
+    if uni is not None:
+        uni_info, keyboard = build_university_card(uni_id, uni)
+        if card_messages.get(uni_id) == query.message.message_id:
+            # Карточка сейчас показывает подробности - возвращаем ее на месте
+            await show_in_place(query.message, uni_info, keyboard)
+        else:
+            # Карточка осталась выше в чате: показываем ее внизу заново, фото уходит по file_id
+            message = await send_university_photo(
+                context.bot,
+                chat_id,
+                uni['name'],
+                caption=uni_info,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
+            card_messages[uni_id] = message.message_id
+        return SHOWING_UNIVERSITIES
+
+    image_tasks = [prefetch_university_image(uni['name']) for _, uni in universities]
+
+    for (uni_id, uni), image_task in zip(universities, image_tasks):
+        uni_info, keyboard = build_university_card(uni_id, uni)
         
         try:
-            img_data = await get_university_image(uni['name'])
-            await context.bot.send_photo(
-                chat_id=update.callback_query.message.chat_id,
-                photo=img_data,
+            message = await send_university_photo(
+                context.bot,
+                chat_id,
+                uni['name'],
+                image_task=image_task,
                 caption=uni_info,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=keyboard,
                 parse_mode='Markdown'
             )
-            await asyncio.sleep(1)
         except Exception as e:
-            print(f"Error sending photo for {uni['name']}: {str(e)}")
-            await query.message.reply_text(
+            report_error('handle_back_action', e, uni['name'])
+            message = await query.message.reply_text(
                 uni_info,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=keyboard,
                 parse_mode='Markdown'
             )
+        card_messages[uni_id] = message.message_id
 
     final_keyboard = [[InlineKeyboardButton("🔄 Начать поиск заново", callback_data="restart")]]
     await query.message.reply_text(
@@ -648,39 +3085,6 @@ async def handle_back_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     
     return SHOWING_UNIVERSITIES
-async def handle_university_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    question = update.message.text
-    selected_uni = context.user_data.get('selected_uni')
-    
-    prompt = f"""
-    Вопрос про университет {selected_uni['name']}:
-    {question}
-
-    Контекст об университете:
-    {json.dumps(selected_uni, ensure_ascii=False)}
-
-    Дай максимально подробный и полезный ответ на вопрос студента.
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        
-        keyboard = [[InlineKeyboardButton("↩️ Вернуться к информации", callback_data="back")]]
-        
-        await update.message.reply_text(
-            f"*Ответ на ваш вопрос про {selected_uni['name']}:*\n\n"
-            f"{response.text}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return SHOWING_UNIVERSITIES
-        
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        await update.message.reply_text(
-            "❌ Произошла ошибка при обработке вопроса. Попробуйте спросить иначе."
-        )
-        return SHOWING_UNIVERSITIES
 async def update_loading_message(message, initial_text="🔄 Загрузка"):
     loading_states = [
         f"{initial_text}",
@@ -697,8 +3101,737 @@ async def update_loading_message(message, initial_text="🔄 Загрузка"):
             break
 
 
-def main():
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK = range(3)
+
+ENDPOINT_PRIORITIES = {
+    'answerCallbackQuery': PRIORITY_INTERACTIVE,
+    'sendChatAction': PRIORITY_INTERACTIVE,
+    'deleteMessage': PRIORITY_INTERACTIVE,
+    'sendPhoto': PRIORITY_BULK,
+    'sendMediaGroup': PRIORITY_BULK,
+}
+
+# Индикатор набора и правка уже отправленных сообщений не расходуют лимит чата на сообщения,
+# иначе каждое нажатие кнопки и каждый шаг потокового ответа ждали бы по секунде
+CHAT_LIMIT_EXEMPT_ENDPOINTS = {'sendChatAction', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'}
+
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик всех запросов к Bot API.
+
+    Держит общее ведро токенов (лимит Telegram ~30 сообщений в секунду) и по ведру на чат
+    (кроме CHAT_LIMIT_EXEMPT_ENDPOINTS), пропускает запросы по приоритету (ответы на кнопки раньше карточек) и при RetryAfter
+    приостанавливает отправку на указанное Telegram время и повторяет запрос.
+    Приоритет можно передать явно через rate_limit_args.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int,
+                 group_rate: float, max_retries: int):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.stats = Counter()
+        self.queue_depth = Counter()
+        self._global_bucket = None
+        self._chat_buckets = {}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._pause_until = 0.0
+        self._dispatcher = None
+
+    async def initialize(self) -> None:
+        # Application и Updater инициализируют бота по очереди, а диспетчер уже ждет
+        # на текущем событии, поэтому повторный вызов ничего не пересоздает
+        if self._wakeup is not None:
+            return
+        self._global_bucket = TokenBucket(self.global_rate, self.global_rate, asyncio.get_running_loop().time())
+        self._wakeup = asyncio.Event()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for _, _, _, _, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+        self.queue_depth.clear()
+        self._wakeup = None
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if not value.is_full(now)
+                }
+            # Отрицательные id и @username - группы и каналы, для них лимит строже
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _delay(self, chat_id, per_chat: bool, now: float) -> float:
+        if chat_id is None:
+            return 0.0
+        if not per_chat:
+            return self._global_bucket.delay(now)
+        return max(self._global_bucket.delay(now), self._chat_bucket(chat_id, now).delay(now))
+
+    def _grant(self, chat_id, per_chat: bool) -> None:
+        if chat_id is not None:
+            self._global_bucket.take()
+            if per_chat:
+                self._chat_buckets[chat_id].take()
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            timeout = None
+            if now < self._pause_until:
+                timeout = self._pause_until - now
+            elif self._waiters:
+                deferred = []
+                while self._waiters:
+                    entry = heapq.heappop(self._waiters)
+                    priority, _, chat_id, per_chat, future = entry
+                    if future.done():
+                        self.queue_depth[priority] -= 1
+                        continue
+                    delay = self._delay(chat_id, per_chat, now)
+                    if delay == 0:
+                        self._grant(chat_id, per_chat)
+                        self.queue_depth[priority] -= 1
+                        future.set_result(None)
+                        continue
+                    deferred.append(entry)
+                    timeout = delay if timeout is None else min(timeout, delay)
+                for entry in deferred:
+                    heapq.heappush(self._waiters, entry)
+
+            if timeout is None:
+                await self._wakeup.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _acquire(self, chat_id, priority: int, per_chat: bool = True) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), chat_id, per_chat, future))
+        self.queue_depth[priority] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_NORMAL)
+        chat_id = data.get('chat_id')
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        per_chat = endpoint not in CHAT_LIMIT_EXEMPT_ENDPOINTS
+
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            await self._acquire(chat_id, priority, per_chat)
+            started = time.perf_counter()
+            metrics.observe('univi_telegram_queue_seconds', started - queued, priority=priority)
+            outcome = 'error'
+            try:
+                result = await callback(*args, **kwargs)
+                outcome = 'ok'
+                self.stats['sent'] += 1
+                return result
+            except RetryAfter as e:
+                outcome = 'retry_after'
+                self.stats['retry_after'] += 1
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    # С PTB_TIMEDELTA (и в следующих версиях PTB) - timedelta, иначе секунды
+                    retry_after = retry_after.total_seconds()
+                print(f"Flood limit hit on {endpoint}, pausing sends for {retry_after}s")
+                # Flood wait действует на весь бот, поэтому останавливаем все отправки
+                self._pause_until = max(self._pause_until, asyncio.get_running_loop().time() + retry_after + 0.1)
+                self._wakeup.set()
+            finally:
+                metrics.observe(
+                    'univi_telegram_request_seconds', time.perf_counter() - started,
+                    method=endpoint, outcome=outcome
+                )
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных чатов параллельно, а апдейты одного чата строго по очереди"""
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        # Семафор базового класса ограничивает число апдейтов, взятых в работу (включая ждущие
+        # своей очереди в чате), а собственный - число реально выполняющихся обработчиков,
+        # чтобы один активный чат не занимал все слоты. Остальные апдейты Application держит
+        # задачами без ограничения; в режиме вебхука их число сдерживает WEBHOOK_MAX_QUEUE
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._concurrency_limit = max_concurrent_updates
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        # Application превращает каждый апдейт в задачу сразу, поэтому его очередь почти всегда
+        # пуста, а настоящая очередь - это задачи, которые ждут здесь
+        self.in_flight = 0
+        # Вызывается с каждым обработанным апдейтом (счетчик обработчика, нагрузочный тест)
+        self.on_processed = None
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    @staticmethod
+    def _is_restart(update) -> bool:
+        message = update.effective_message
+        return bool(message and message.text and message.text.startswith('/start'))
+
+    async def process_update(self, update, coroutine) -> None:
+        self.in_flight += 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.in_flight -= 1
+            if self.on_processed is not None:
+                self.on_processed(update)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat_id = self._chat_key(update)
+        if chat_id is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        if self._is_restart(update):
+            # /start ждет в очереди чата, поэтому зависшую генерацию нужно прервать сразу
+            llm.cancel(chat_id)
+
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        self._workers = asyncio.Semaphore(self._concurrency_limit)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+
+
+def pending_updates(application: Application) -> int:
+    """Апдейты, принятые, но еще не обработанные: в очереди Application и в задачах обработки"""
+    processor = application.update_processor
+    return application.update_queue.qsize() + getattr(processor, 'in_flight', 0)
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранит user_data, chat_data и состояния диалогов в SQLite.
+
+    Application передает изменения раз в update_interval секунд; все изменения одного
+    прохода записываются одной транзакцией. Данные пользователя и чата читаются из базы
+    только при первом обращении к ним. Сессии, не обновлявшиеся дольше idle_ttl, удаляются
+    вместе с состояниями диалогов при запуске и периодически при записи.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, update_interval: float, idle_ttl: float = 0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self._connection = None
+        # Одного потока достаточно, а все обращения к соединению идут последовательно
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._writes = 0
+        self._loaded = set()
+        self._pending_data = {}
+        self._pending_conversations = {}
+        self._write_task = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            # WAL позволяет нескольким процессам читать базу, пока один из них пишет
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    kind TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    data BLOB,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (kind, id)
+                );
+                CREATE TABLE IF NOT EXISTS conversations (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state BLOB NOT NULL,
+                    PRIMARY KEY (name, key)
+                );
+            """)
+            self._prune(self._connection)
+        return self._connection
+
+    def _prune(self, connection: sqlite3.Connection) -> None:
+        if self.idle_ttl <= 0:
+            return
+        with connection:
+            # Пользователь - последняя часть ключа диалога
+            connection.execute(
+                "DELETE FROM conversations WHERE json_extract(key, '$[#-1]') IN "
+                "(SELECT id FROM sessions WHERE kind = 'user' AND updated_at < ?)",
+                (time.time() - self.idle_ttl,)
+            )
+            connection.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - self.idle_ttl,))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load_session(self, kind: str, entity_id: int):
+        row = self._connect().execute(
+            'SELECT data FROM sessions WHERE kind = ? AND id = ?', (kind, entity_id)
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _load_conversations(self, name: str) -> dict:
+        rows = self._connect().execute(
+            'SELECT key, state FROM conversations WHERE name = ?', (name,)
+        ).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def _write_batch(self, data: dict, conversations: dict) -> None:
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            for (kind, entity_id), value in data.items():
+                if value is None:
+                    connection.execute(
+                        'DELETE FROM sessions WHERE kind = ? AND id = ?', (kind, entity_id)
+                    )
+                    if kind == 'user':
+                        connection.execute(
+                            "DELETE FROM conversations WHERE json_extract(key, '$[#-1]') = ?", (entity_id,)
+                        )
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO sessions (kind, id, data, updated_at) VALUES (?, ?, ?, ?)',
+                        (kind, entity_id, pickle.dumps(value), now)
+                    )
+            for (name, key), state in conversations.items():
+                if state is None:
+                    connection.execute(
+                        'DELETE FROM conversations WHERE name = ? AND key = ?', (name, key)
+                    )
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                        (name, key, pickle.dumps(state))
+                    )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune(connection)
+
+    def _schedule_write(self) -> None:
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        # Application вызывает update_* для всех измененных записей разом,
+        # поэтому даем им добавиться в пакет, прежде чем писать
+        await asyncio.sleep(0)
+        while self._pending_data or self._pending_conversations:
+            data, self._pending_data = self._pending_data, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            try:
+                await self._run(self._write_batch, data, conversations)
+            except sqlite3.Error as e:
+                report_error('persistence', e)
+                continue
+            # Удаленные записи больше не нужно помнить: новые данные, если появятся, прочитаются из базы
+            self._loaded.difference_update(key for key, value in data.items() if value is None)
+
+    async def _refresh(self, kind: str, entity_id: int, data: dict) -> None:
+        if (kind, entity_id) in self._loaded:
+            return
+        self._loaded.add((kind, entity_id))
+        stored = await self._run(self._load_session, kind, entity_id)
+        if stored and not data:
+            data.update(stored)
+
+    async def _update(self, kind: str, entity_id: int, data) -> None:
+        self._loaded.add((kind, entity_id))
+        self._pending_data[(kind, entity_id)] = data
+        self._schedule_write()
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._update('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._update('chat', chat_id, data)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._update('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._update('chat', chat_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+
+
+class SessionJanitor:
+    """Удаляет данные пользователей, которые не пишут боту дольше idle_ttl.
+
+    Данные удаляются через Application, поэтому и из хранилища сессий вместе с состоянием диалога:
+    вернувшись, пользователь начинает с /start. Проверяются только самые давние сессии, поэтому каждое обращение
+    обходится в O(1). Заодно запоминает, в каком состоянии диалога находится пользователь.
+    """
+
+    def __init__(self, idle_ttl: float):
+        self.idle_ttl = idle_ttl
+        self.stats = Counter()
+        self._last_seen = OrderedDict()
+        self._states = {}
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
+
+    def touch(self, application: Application, user_id: int) -> None:
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        self._last_seen[user_id] = now
+        self._last_seen.move_to_end(user_id)
+        while self._last_seen:
+            oldest, last_seen = next(iter(self._last_seen.items()))
+            if now - last_seen < self.idle_ttl:
+                break
+            del self._last_seen[oldest]
+            self.evict(application, oldest)
+
+    def set_state(self, user_id: int, state) -> None:
+        """Состояние, которое вернул обработчик диалога; None оставляет прежнее"""
+        if state == ConversationHandler.END:
+            self._states.pop(user_id, None)
+        elif state is not None:
+            self._states[user_id] = state
+
+    def conversations(self) -> Counter:
+        """Число диалогов в каждом состоянии"""
+        return Counter(self._states.values())
+
+    def evict(self, application: Application, user_id: int) -> None:
+        # Личный чат совпадает с пользователем
+        application.drop_user_data(user_id)
+        application.drop_chat_data(user_id)
+        self._states.pop(user_id, None)
+        self.stats['evicted'] += 1
+
+
+session_janitor = SessionJanitor(SESSION_IDLE_TTL)
+
+
+async def session_expired(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ответ пользователю, чья сессия удалена за неактивностью"""
+    if update.callback_query is not None:
+        await update.callback_query.answer()
+    if update.effective_message is not None:
+        await update.effective_message.reply_text("⌛ Сессия истекла. Чтобы начать заново, используй команду /start")
+    return ConversationHandler.END
+
+
+def instrument_handler(callback, state: str):
+    """Оборачивает обработчик диалога, чтобы измерять время его работы и отмечать активность сессий"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        if update.effective_user is not None:
+            session_janitor.touch(context.application, update.effective_user.id)
+        try:
+            if state not in ('entry', 'fallback') and 'state' not in context.user_data:
+                # Сессию удалил SessionJanitor, а диалог остался в прежнем состоянии - завершаем его
+                next_state = await session_expired(update, context)
+            else:
+                with deadline(HANDLER_DEADLINE):
+                    next_state = await callback(update, context)
+            if update.effective_user is not None:
+                session_janitor.set_state(update.effective_user.id, next_state)
+            return next_state
+        except Exception as e:
+            metrics.inc('univi_errors_total', where=callback.__name__, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe(
+                'univi_handler_seconds', time.perf_counter() - started,
+                state=state, handler=callback.__name__
+            )
+    return wrapper
+
+
+def instrument_conversation(conv_handler: ConversationHandler) -> None:
+    """Подключает замер времени ко всем обработчикам диалога"""
+    groups = [('entry', conv_handler.entry_points), ('fallback', conv_handler.fallbacks)]
+    groups.extend((STATE_NAMES[state], handlers) for state, handlers in conv_handler.states.items())
+    for state, handlers in groups:
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback, state)
+
+
+def cache_lookups() -> dict:
+    return {
+        'image': (image_cache.stats['memory_hits'] + image_cache.stats['disk_hits'], image_cache.stats['misses']),
+        'file_id': (file_id_store.stats['hits'], file_id_store.stats['misses']),
+        'answer': (answer_cache.stats['hits'], answer_cache.stats['misses']),
+        'recommendation': (recommendation_cache.hits, recommendation_cache.misses),
+        'shared': (shared_store.stats['hits'], shared_store.stats['misses'])
+    }
+
+
+def register_runtime_metrics(application: Application, scheduler) -> None:
+    """Регистрирует показатели, которые вычисляются при чтении /metrics"""
+    def active_conversations():
+        # Считаем по состояниям, которые вернули обработчики: после перезапуска диалог
+        # учитывается с первого действия пользователя
+        counts = session_janitor.conversations()
+        return [({'state': name}, counts.get(state, 0)) for state, name in STATE_NAMES.items()]
+
+    def lookups():
+        samples = []
+        for cache, (hits, misses) in cache_lookups().items():
+            samples.append(({'cache': cache, 'result': 'hit'}, hits))
+            samples.append(({'cache': cache, 'result': 'miss'}, misses))
+        return samples
+
+    def hit_ratios():
+        return [
+            ({'cache': cache}, hits / (hits + misses) if hits + misses else 0.0)
+            for cache, (hits, misses) in cache_lookups().items()
+        ]
+
+    metrics.collector('univi_active_conversations', 'gauge', 'Активные диалоги по состояниям', active_conversations)
+    metrics.collector('univi_cache_lookups_total', 'counter', 'Обращения к кэшам', lookups)
+    metrics.collector('univi_cache_hit_ratio', 'gauge', 'Доля попаданий в кэш', hit_ratios)
+    metrics.collector('univi_coalesced_requests_total', 'counter', 'Запросы, объединенные с уже выполняющимися', lambda: [
+        ({'flight': 'image'}, image_flight.stats['coalesced']),
+        ({'flight': 'gemini'}, llm._flight.stats['coalesced'] + llm.stats['coalesced_streams'])
+    ])
+    metrics.collector('univi_telegram_queue_depth', 'gauge', 'Запросы в очереди отправки по приоритетам', lambda: [
+        ({'priority': priority}, depth) for priority, depth in sorted(scheduler.queue_depth.items())
+    ])
+    metrics.collector('univi_telegram_scheduler_events_total', 'counter', 'События планировщика отправки', lambda: [
+        ({'event': event}, count) for event, count in sorted(scheduler.stats.items())
+    ])
+    metrics.collector('univi_qa_sessions', 'gauge', 'Активные сессии вопросов об университетах', lambda: [
+        ({}, len(qa_sessions))
+    ])
+    metrics.collector('univi_qa_session_events_total', 'counter', 'События сессий вопросов', lambda: [
+        ({'event': event}, count) for event, count in sorted(qa_sessions.stats.items())
+    ])
+    metrics.collector('univi_sessions', 'gauge', 'Сессии пользователей в памяти', lambda: [
+        ({}, len(application.user_data))
+    ])
+    metrics.collector('univi_sessions_evicted_total', 'counter', 'Сессии, удаленные после простоя', lambda: [
+        ({}, session_janitor.stats['evicted'])
+    ])
+    metrics.collector('univi_university_records', 'gauge', 'Записи университетов в общем хранилище', lambda: [
+        ({}, len(university_store))
+    ])
+    metrics.collector('univi_speculation_events_total', 'counter', 'События спекулятивного подбора', lambda: [
+        ({'event': event}, count) for event, count in sorted(speculator.stats.items())
+    ])
+    metrics.collector('univi_speculation_running', 'gauge', 'Выполняющиеся спекулятивные подборы', lambda: [
+        ({}, speculator.running())
+    ])
+    metrics.collector('univi_circuit_state', 'gauge', 'Состояние предохранителей: 0 - замкнут, 1 - пробный запрос, 2 - разомкнут', lambda: [
+        ({'dependency': name}, breaker.state) for name, breaker in sorted(circuit_breakers.items())
+    ])
+    metrics.collector('univi_updates_in_flight', 'gauge', 'Принятые и еще не обработанные апдейты', lambda: [
+        ({}, pending_updates(application))
+    ])
+
+
+class MetricsServer:
+    """HTTP-сервер, отдающий метрики на /metrics"""
+
+    def __init__(self, registry: Metrics):
+        self.registry = registry
+        self._runner = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def start(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(metrics)
+
+
+# Номер процесса-обработчика в многопроцессном режиме, None - бот работает одним процессом
+worker_index = None
+
+
+async def on_startup(application: Application) -> None:
+    await open_http_session(application)
+    if METRICS_ENABLED:
+        # Каждый обработчик отдает свои метрики на соседнем порту
+        port = METRICS_PORT + worker_index if METRICS_PORT and worker_index else METRICS_PORT
+        try:
+            await metrics_server.start(METRICS_LISTEN, port)
+        except OSError as e:
+            # Занятый порт метрик не должен мешать работе бота
+            report_error('metrics_server', e)
+
+
+async def on_shutdown(application: Application) -> None:
+    await metrics_server.stop()
+    await close_http_session(application)
+    await shared_store.close()
+
+
+def create_scheduler() -> SendScheduler:
+    # Общий лимит Bot API делится между процессами; лимиты на чат не меняются,
+    # потому что чат всегда обрабатывается одним процессом
+    return SendScheduler(
+        SEND_GLOBAL_RATE / WORKERS, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GROUP_RATE, SEND_MAX_RETRIES
+    )
+
+
+def create_bot(rate_limiter=None) -> ExtBot:
+    """Бот для работы вне Application (диспетчер процессов, прогрев кэшей)"""
+    urls = {}
+    if TELEGRAM_API_URL:
+        urls = {'base_url': f"{TELEGRAM_API_URL}/bot", 'base_file_url': f"{TELEGRAM_API_URL}/file/bot"}
+    return ExtBot(os.getenv('TELEGRAM_TOKEN'), rate_limiter=rate_limiter, **urls)
+
+
+def build_application(updater: bool = True) -> Application:
+    """Создает приложение бота со всеми обработчиками.
+
+    updater=False - апдейты получает не само приложение, а диспетчер, который передает их
+    в update_queue.
+    """
+    scheduler = create_scheduler()
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+        .rate_limiter(scheduler)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if not updater:
+        builder = builder.updater(None)
+    if PERSISTENCE_ENABLED:
+        builder = builder.persistence(
+            SQLitePersistence(PERSISTENCE_PATH, PERSISTENCE_UPDATE_INTERVAL, SESSION_IDLE_TTL)
+        )
+    application = builder.build()
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -724,22 +3857,490 @@ def main():
                 CommandHandler('skip', skip)
             ],
             SHOWING_UNIVERSITIES: [
-                CallbackQueryHandler(handle_back_action, pattern="^back$"),
+                CallbackQueryHandler(handle_back_action, pattern="^back(_\\w+)?$"),
                 CallbackQueryHandler(handle_university_selection)
             ],
             UNIVERSITY_INFO: [
-                CallbackQueryHandler(handle_back_action, pattern="^back$"),
+                CallbackQueryHandler(handle_back_action, pattern="^back(_\\w+)?$"),
                 CallbackQueryHandler(handle_university_selection)
             ],
             UNIVERSITY_QUESTIONS: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_university_question),
-                CallbackQueryHandler(handle_back_action, pattern="^back$")
+                CallbackQueryHandler(handle_back_action, pattern="^back(_\\w+)?$")
             ]
         },
-        fallbacks=[CommandHandler('start', start)]
+        fallbacks=[CommandHandler('start', start)],
+        name='university_search',
+        persistent=PERSISTENCE_ENABLED
     )
+    instrument_conversation(conv_handler)
+    register_runtime_metrics(application, scheduler)
     
     application.add_handler(conv_handler)
-    application.run_polling()
+    return application
+
+
+class WebhookServer:
+    """Встроенный HTTP-сервер, принимающий апдейты от Telegram"""
+
+    def __init__(self, enqueue, pending, is_ready, path: str, secret_token: str, max_queue: int):
+        self.enqueue = enqueue
+        self.pending = pending
+        self.is_ready = is_ready
+        self.path = path
+        self.secret_token = secret_token
+        self.max_queue = max_queue
+        self._runner = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                return web.Response(status=403)
+
+        # Telegram повторит доставку позже, так что при переполнении просто отказываем
+        if self.pending() >= self.max_queue:
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        await self.enqueue(data)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        if self.is_ready() and self.pending() < self.max_queue:
+            return web.Response(text='ready')
+        return web.Response(status=503, text='not ready')
+
+    async def start(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/healthz', self.handle_health)
+        app.router.add_get('/readyz', self.handle_ready)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def wait_for_stop_signal() -> None:
+    """Ждет SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+
+@contextlib.asynccontextmanager
+async def running_application(application: Application):
+    """Запускает приложение без встроенного получения апдейтов и останавливает его при выходе"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        yield application
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме вебхука"""
+    async def enqueue(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = WebhookServer(
+        enqueue,
+        lambda: pending_updates(application),
+        lambda: application.running,
+        WEBHOOK_PATH,
+        WEBHOOK_SECRET_TOKEN,
+        WEBHOOK_MAX_QUEUE
+    )
+
+    async with running_application(application):
+        try:
+            await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES
+            )
+            await wait_for_stop_signal()
+        finally:
+            await server.stop()
+
+
+def update_chat_id(data: dict):
+    """Чат, к которому относится апдейт в виде JSON, None - если чата нет"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        # message, callback_query.message, my_chat_member и т. п.; иначе - отправитель
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        chat = chat or value.get('from') or value.get('user')
+        if chat and 'id' in chat:
+            return chat['id']
+    return None
+
+
+async def serve_worker(inbox, completed) -> None:
+    """Обрабатывает апдейты, которые диспетчер присылает в inbox, пока не придет None.
+
+    Число обработанных апдейтов процесс ведет в общем счетчике completed, по нему диспетчер
+    считает, сколько апдейтов еще не обработано.
+    """
+    application = build_application(updater=False)
+
+    def count_processed(update):
+        with completed.get_lock():
+            completed.value += 1
+
+    application.update_processor.on_processed = count_processed
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, inbox.put, None)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    async with running_application(application):
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+
+
+def run_worker(index: int, inbox, completed) -> None:
+    """Точка входа процесса-обработчика"""
+    global worker_index
+    worker_index = index
+    # Ctrl+C получает вся группа процессов, а останавливать обработчики должен диспетчер,
+    # иначе апдейты, уже переданные в очередь, потеряются
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(inbox, completed))
+
+
+class ShardDispatcher:
+    """Распределяет апдейты между процессами-обработчиками по chat_id.
+
+    Апдейты одного чата всегда попадают в один и тот же процесс, поэтому порядок их
+    обработки и состояние диалога в памяти процесса сохраняются. Упавший процесс
+    перезапускается и поднимает диалоги из общей базы.
+    """
+
+    def __init__(self, workers: int, stop_timeout: float = 30):
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.stats = Counter()
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes = [self._context.Queue() for _ in range(workers)]
+        self._dispatched = [0] * workers
+        self._completed = [self._context.Value('q', 0) for _ in range(workers)]
+        self._processes = [None] * workers
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker, args=(index, self._inboxes[index], self._completed[index]),
+            name=f'univi-worker-{index}'
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def is_ready(self) -> bool:
+        return all(process is not None and process.is_alive() for process in self._processes)
+
+    def pending(self) -> int:
+        """Апдейты, отправленные обработчикам и еще не обработанные (в очередях и в работе)"""
+        return sum(
+            dispatched - completed.value for dispatched, completed in zip(self._dispatched, self._completed)
+        )
+
+    def dispatch(self, data: dict) -> None:
+        chat_id = update_chat_id(data)
+        key = chat_id if chat_id is not None else data.get('update_id', 0)
+        index = key % self.workers
+        self._inboxes[index].put(data)
+        self._dispatched[index] += 1
+        self.stats['dispatched'] += 1
+
+    async def supervise(self, interval: float = 1) -> None:
+        """Перезапускает упавшие процессы"""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    print(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self.stats['restarts'] += 1
+                    # Процесс мог погибнуть, держа блокировку чтения очереди или счетчика, поэтому
+                    # новый получает свежие; апдейты, не обработанные старым, теряются
+                    self._inboxes[index] = self._context.Queue()
+                    self._dispatched[index] = 0
+                    self._completed[index] = self._context.Value('q', 0)
+                    self._spawn(index)
+
+    def stop(self) -> None:
+        for inbox in self._inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + self.stop_timeout
+        for process in self._processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+async def run_sharded(mode: str, workers: int) -> None:
+    """Получает апдейты в этом процессе и раздает их обработчикам в workers процессах"""
+    dispatcher = ShardDispatcher(workers)
+    dispatcher.start()
+    supervisor = asyncio.ensure_future(dispatcher.supervise())
+
+    bot = create_bot()
+    try:
+        if mode == 'webhook':
+            async def enqueue(data):
+                dispatcher.dispatch(data)
+
+            server = WebhookServer(
+                enqueue,
+                dispatcher.pending,
+                dispatcher.is_ready,
+                WEBHOOK_PATH,
+                WEBHOOK_SECRET_TOKEN,
+                WEBHOOK_MAX_QUEUE
+            )
+            async with bot:
+                try:
+                    await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+                    await bot.set_webhook(
+                        url=WEBHOOK_URL,
+                        secret_token=WEBHOOK_SECRET_TOKEN,
+                        allowed_updates=Update.ALL_TYPES
+                    )
+                    await wait_for_stop_signal()
+                finally:
+                    await server.stop()
+        else:
+            updates = asyncio.Queue()
+
+            async def forward():
+                while True:
+                    dispatcher.dispatch((await updates.get()).to_dict())
+
+            async with Updater(bot, updates) as updater:
+                await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                forwarder = asyncio.ensure_future(forward())
+                try:
+                    await wait_for_stop_signal()
+                finally:
+                    await updater.stop()
+                    forwarder.cancel()
+                    while not updates.empty():
+                        dispatcher.dispatch(updates.get_nowait().to_dict())
+    finally:
+        supervisor.cancel()
+        # join блокирует, поэтому ждем процессы вне цикла событий
+        await asyncio.get_running_loop().run_in_executor(None, dispatcher.stop)
+
+
+def parse_warm_profiles(spec: str) -> list:
+    """Разбирает профили вида "3.5/1350/6.5,-/-/7.0" (GPA/SAT/IELTS, "-" - шаг пропущен)"""
+    profiles = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        values = [value.strip() for value in item.split('/')]
+        if len(values) != 3:
+            raise ValueError(f"Profile must look like GPA/SAT/IELTS: {item}")
+        profiles.append({key: value for key, value in zip(('gpa', 'sat', 'ielts'), values) if value not in ('', '-')})
+    return profiles
+
+
+def read_warm_locations(path: str) -> list:
+    """Страны и города из файла, по одному в строке; строки с # пропускаются"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+class CacheWarmer:
+    """Заранее подбирает университеты для популярных запросов и заполняет кэши.
+
+    Для каждой пары (страна, профиль) заново генерируются рекомендации - они попадают в кэш
+    рекомендаций, общее хранилище и каталог. Для каждого найденного университета скачивается
+    и пережимается фото, а если задан чат, фото загружается в Telegram ради file_id и сразу
+    удаляется из чата.
+    """
+
+    def __init__(self, bot, chat_id, concurrency: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.stats = Counter()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._universities = {}
+        self._started = None
+        self._total = 0
+        self._done = 0
+
+    @staticmethod
+    def describe(profile: dict) -> str:
+        scores = '/'.join(str(profile.get(key, '-')) for key in ('gpa', 'sat', 'ielts'))
+        return f"{profile['country']} {scores}"
+
+    async def run(self, profiles: list) -> None:
+        self._started = time.perf_counter()
+        self._total = len(profiles)
+        await asyncio.gather(*(self.warm_profile(profile) for profile in profiles))
+
+    async def warm_profile(self, profile: dict) -> None:
+        async with self._semaphore:
+            with deadline(HANDLER_DEADLINE):
+                try:
+                    universities = await get_recommendations(profile, use_cache=False)
+                    self.stats['profiles'] += 1
+                except Exception as e:
+                    report_error('warm_cache', e, self.describe(profile))
+                    self.stats['failed_profiles'] += 1
+                    universities = []
+                await asyncio.gather(*(self.warm_university(uni['name']) for uni in universities if uni.get('name')))
+
+        self._done += 1
+        done = self._done
+        elapsed = time.perf_counter() - self._started
+        print(f"[{done}/{self._total}] {self.describe(profile)}: {len(universities)} universities, "
+              f"{done / elapsed * 60:.1f} profiles/min")
+
+    def warm_university(self, uni_name: str):
+        # Один и тот же университет встречается во многих подборках - обрабатываем его один раз
+        key = normalize_university_name(uni_name)
+        task = self._universities.get(key)
+        if task is None:
+            task = self._universities[key] = asyncio.ensure_future(self._warm_university(uni_name))
+        return task
+
+    async def _warm_university(self, uni_name: str) -> None:
+        img_data = await get_university_image_bytes(uni_name)
+        self.stats['images' if img_data is not None else 'missing_images'] += 1
+        if img_data is None or self.bot is None or await file_id_store.lookup(uni_name):
+            return
+        try:
+            message = await send_university_photo(self.bot, self.chat_id, uni_name, disable_notification=True)
+            self.stats['uploads'] += 1
+            await self.bot.delete_message(chat_id=self.chat_id, message_id=message.message_id)
+        except TelegramError as e:
+            report_error('warm_cache', e, uni_name)
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self._started
+        return "\n".join([
+            f"Warmed {self.stats['profiles']}/{self._total} profiles and {len(self._universities)} universities "
+            f"in {elapsed:.1f} s ({self._total / elapsed * 60:.1f} profiles/min)",
+            f"Images: {self.stats['images']} cached, {self.stats['missing_images']} not found; "
+            f"file_id uploads: {self.stats['uploads']}",
+            f"Quota used: Gemini {metrics.total('univi_gemini_request_seconds'):.0f} requests "
+            f"({metrics.total('univi_gemini_tokens_total'):.0f} tokens), "
+            f"Custom Search {metrics.total('univi_image_search_seconds'):.0f} requests, "
+            f"image downloads {metrics.total('univi_image_download_seconds'):.0f}",
+        ])
+
+
+async def run_cache_warming(locations: list, profiles: list, concurrency: int) -> None:
+    """Прогревает кэши для всех сочетаний стран и профилей"""
+    # Расход квоты считается по метрикам, поэтому в этом процессе они нужны всегда
+    metrics.enabled = True
+    bot = None
+    if WARM_CACHE_CHAT_ID:
+        bot = create_bot(create_scheduler())
+        await bot.initialize()
+    else:
+        print("WARM_CACHE_CHAT_ID is not set, file_id store will not be warmed")
+
+    warmer = CacheWarmer(bot, WARM_CACHE_CHAT_ID, concurrency)
+    try:
+        await warmer.run([dict(profile, country=location) for location in locations for profile in profiles])
+    finally:
+        if bot is not None:
+            await bot.shutdown()
+        await close_http_session(None)
+        await shared_store.close()
+    print(warmer.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UNIVI - Telegram-бот для подбора университетов')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=BOT_MODE,
+                        help='способ получения апдейтов (по умолчанию BOT_MODE или polling)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='число процессов-обработчиков (по умолчанию WORKERS или 1)')
+    parser.add_argument('--import-catalog', metavar='FILE',
+                        help='импортировать университеты в каталог из JSON или CSV и выйти')
+    parser.add_argument('--warm-cache', metavar='FILE',
+                        help='прогреть кэши для стран и городов из файла (по одному в строке) и выйти')
+    parser.add_argument('--warm-profiles', default=WARM_CACHE_PROFILES,
+                        help='профили для прогрева: GPA/SAT/IELTS через запятую, "-" - шаг пропущен')
+    parser.add_argument('--warm-concurrency', type=int, default=WARM_CACHE_CONCURRENCY,
+                        help='сколько профилей прогревать одновременно')
+    args = parser.parse_args()
+
+    if args.warm_cache:
+        try:
+            profiles = parse_warm_profiles(args.warm_profiles)
+        except ValueError as e:
+            parser.error(str(e))
+        # Бот видит прогретые рекомендации и file_id только через общее хранилище
+        shared_store.enabled = os.getenv('SHARED_STORE_ENABLED', '1') == '1'
+        asyncio.run(run_cache_warming(read_warm_locations(args.warm_cache), profiles, args.warm_concurrency))
+        return
+
+    if args.import_catalog:
+        count = catalog.import_file(args.import_catalog)
+        print(f"Imported {count} universities into {CATALOG_PATH}")
+        return
+
+    if args.mode == 'webhook' and not WEBHOOK_URL:
+        parser.error('для режима webhook нужна переменная WEBHOOK_URL')
+
+    if args.workers > 1:
+        # Обработчики читают настройки из окружения при импорте модуля
+        os.environ['WORKERS'] = str(args.workers)
+        asyncio.run(run_sharded(args.mode, args.workers))
+        return
+
+    application = build_application()
+    if args.mode == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file